@@ -1,9 +1,15 @@
+import json
 import logging
+import os
+import random
 import re
+import tempfile
 import time
 import warnings
 
+from robot.api import logger
 from robot.libraries.BuiltIn import BuiltIn, RobotNotRunningError
+from robot.utils import is_truthy
 from selenium.common.exceptions import ElementNotInteractableException
 from selenium.common.exceptions import StaleElementReferenceException
 from selenium.common.exceptions import NoSuchElementException
@@ -19,7 +25,7 @@ from email.mime import text
 
 from cumulusci.tasks.apex.anon import AnonymousApexTask
 from cumulusci.core.config import TaskConfig
-from cumulusci.tasks.apex.batch import BatchApexWait
+from cumulusci.utils import parse_api_datetime
 
 from locators_45 import npsp_lex_locators as locators_45
 from locators_46 import npsp_lex_locators as locators_46
@@ -30,28 +36,85 @@ locators_by_api_version = {
 # will get populated in _init_locators
 npsp_lex_locators = {}
 
+# The latest API version of each org, by instance URL, is cached here so
+# that _init_locators doesn't have to ask the org every time the library
+# is loaded.  ${NPSP_API_VERSION_CACHE} and ${NPSP_API_VERSION_CACHE_TTL}
+# (in seconds) override these defaults.
+API_VERSION_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cumulusci", "npsp_api_versions.json")
+API_VERSION_CACHE_TTL = 24 * 60 * 60
+
+# The names the library looks up in each org's schema, such as the NPSP
+# namespace prefix and the fields of objects, are cached here by instance
+# URL.  An org's entry is dropped when the versions of the packages
+# installed in it change.  ${NPSP_METADATA_CACHE} overrides the path.
+METADATA_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cumulusci", "npsp_metadata.json")
+
+# Rather than sleeping for a fixed time, keywords wait for the page to
+# reach the state they need by checking for it every WAIT_INTERVAL seconds,
+# for up to WAIT_TIMEOUT seconds.  The time each suite spends waiting is
+# logged when the suite ends.
+WAIT_INTERVAL = 0.2
+WAIT_TIMEOUT = 30
+
+# wait_for_apex_job_to_complete first polls the org after
+# APEX_JOB_POLL_INTERVAL seconds and doubles the interval after each poll,
+# up to APEX_JOB_MAX_POLL_INTERVAL.  Each interval is cut short by a random
+# amount, of up to half, so that suites running at once don't poll in step.
+APEX_JOB_POLL_INTERVAL = 1
+APEX_JOB_MAX_POLL_INTERVAL = 30
+APEX_JOB_TIMEOUT = 60 * 60
+APEX_JOB_FINISHED_STATUSES = ("Completed", "Failed", "Aborted")
+
+# verify_expected_values_for_records fetches this many records per query
+VERIFY_CHUNK_SIZE = 200
+
+
+def read_json_cache(path):
+    try:
+        with open(path, "r") as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def write_json_cache(path, cache):
+    # Write a temporary file and rename it into place so that suites
+    # running in parallel never read a half written cache
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(cache, f, indent=4)
+    os.replace(temp_path, path)
+
 @selenium_retry
 class NPSP(object):
     
     ROBOT_LIBRARY_SCOPE = 'GLOBAL'
     ROBOT_LIBRARY_VERSION = 1.0
+    ROBOT_LISTENER_API_VERSION = 2
 
     def __init__(self, debug=False):
+        self.ROBOT_LIBRARY_LISTENER = self
         self.debug = debug
         self.current_page = None
         self._session_records = []
         self.val=0
         self.payment_list= []
+        self._org_metadata = None
+        self._wait_time = 0.0
+        self._suite_wait_times = {}
         # Turn off info logging of all http requests 
         logging.getLogger('requests.packages.urllib3.connectionpool').setLevel(logging.WARN)
         self._init_locators()
 
     def _init_locators(self):
         try:
-            client = self.cumulusci.tooling
-            response = client._call_salesforce(
-                'GET', 'https://{}/services/data'.format(client.sf_instance))
-            latest_api_version = float(response.json()[-1]['version'])
+            latest_api_version = self._get_latest_api_version()
             if not latest_api_version in locators_by_api_version:
                 warnings.warn("Could not find locator library for API %d" % latest_api_version)
                 latest_api_version = max(locators_by_api_version.keys())
@@ -63,6 +126,39 @@ class NPSP(object):
         locators = locators_by_api_version[latest_api_version]
         npsp_lex_locators.update(locators)
 
+    def _get_latest_api_version(self):
+        """ Returns the org's latest API version: ${NPSP_API_VERSION} if it
+            is set, otherwise the version cached for the org's instance if
+            it is recent enough, otherwise the version the org reports,
+            which is then cached.
+        """
+        override = self.builtin.get_variable_value("${NPSP_API_VERSION}")
+        if override:
+            return float(override)
+        path = self.builtin.get_variable_value(
+            "${NPSP_API_VERSION_CACHE}", API_VERSION_CACHE_PATH)
+        ttl = float(self.builtin.get_variable_value(
+            "${NPSP_API_VERSION_CACHE_TTL}", API_VERSION_CACHE_TTL))
+        instance_url = self.cumulusci.org.instance_url
+        cache = read_json_cache(path)
+        try:
+            cached = cache[instance_url]
+            if 0 <= time.time() - cached["time"] < ttl:
+                return float(cached["version"])
+        except (KeyError, TypeError, ValueError):
+            # Not cached, or a partial or hand edited entry: ask the org
+            pass
+        client = self.cumulusci.tooling
+        response = client._call_salesforce(
+            'GET', 'https://{}/services/data'.format(client.sf_instance))
+        latest_api_version = float(response.json()[-1]['version'])
+        cache[instance_url] = {"version": latest_api_version, "time": time.time()}
+        try:
+            write_json_cache(path, cache)
+        except (IOError, OSError) as e:
+            warnings.warn("Could not cache the API version in {}: {}".format(path, e))
+        return latest_api_version
+
     @property
     def builtin(self):
         return BuiltIn()
@@ -85,12 +181,171 @@ class NPSP(object):
             return ''
 
     def get_npsp_namespace_prefix(self):
-        if not hasattr(self.cumulusci, '_describe_result'):
-            self.cumulusci._describe_result = self.cumulusci.sf.describe()
-        objects = self.cumulusci._describe_result['sobjects']
+        metadata = self._get_org_metadata()
+        if "npsp_namespace_prefix" not in metadata:
+            metadata["npsp_namespace_prefix"] = self._find_npsp_namespace_prefix()
+            self._save_org_metadata()
+        return metadata["npsp_namespace_prefix"]
+
+    def get_npsp_object_name(self, name):
+        """ Returns the API name of an NPSP object in this org, which has the
+            NPSP namespace prefix if the org does
+        """
+        return self.get_npsp_namespace_prefix() + name
+
+    def get_npsp_field_name(self, object_name, name):
+        """ Returns the API name of a field of an object in this org: the
+            name with the NPSP namespace prefix if the object has that
+            field, otherwise the name as it is if the object has that.
+        """
+        candidates = [self.get_npsp_namespace_prefix() + name, name]
+        fields = self._get_field_names(object_name)
+        if not any(candidate in fields for candidate in candidates):
+            # The field may have been deployed since the object was cached
+            fields = self._get_field_names(object_name, refresh=True)
+        for candidate in candidates:
+            if candidate in fields:
+                return candidate
+        return candidates[0]
+
+    def _find_npsp_namespace_prefix(self):
+        """ Returns the namespace prefix of the Level object, looking for it
+            by name before falling back to a describe of every object
+        """
+        for prefix in ("npsp__", ""):
+            try:
+                getattr(self.cumulusci.sf, prefix + "Level__c").metadata()
+                return prefix
+            except SalesforceResourceNotFound:
+                pass
+        objects = self.cumulusci.sf.describe()['sobjects']
         level_object = [o for o in objects if o['label'] == 'Level'][0]
         return self.get_namespace_prefix(level_object['name'])
 
+    def _get_field_names(self, object_name, refresh=False):
+        metadata = self._get_org_metadata()
+        if refresh or object_name not in metadata["fields"]:
+            describe = getattr(self.cumulusci.sf, object_name).describe()
+            metadata["fields"][object_name] = [field["name"] for field in describe["fields"]]
+            self._save_org_metadata()
+        return metadata["fields"][object_name]
+
+    def _get_org_metadata(self):
+        """ Returns this org's entry in the metadata cache, which is started
+            again if the versions of the packages installed in the org have
+            changed since it was cached
+        """
+        if self._org_metadata is None:
+            path = self.builtin.get_variable_value(
+                "${NPSP_METADATA_CACHE}", METADATA_CACHE_PATH)
+            package_versions = self._get_package_versions()
+            metadata = read_json_cache(path).get(self.cumulusci.org.instance_url)
+            if not metadata or metadata.get("package_versions") != package_versions:
+                metadata = {"package_versions": package_versions, "fields": {}}
+            self._org_metadata = metadata
+            self._org_metadata_path = path
+        return self._org_metadata
+
+    def _save_org_metadata(self):
+        # Read the cache again so that entries other suites have written
+        # since this one read it are kept
+        cache = read_json_cache(self._org_metadata_path)
+        cache[self.cumulusci.org.instance_url] = self._org_metadata
+        try:
+            write_json_cache(self._org_metadata_path, cache)
+        except (IOError, OSError) as e:
+            warnings.warn("Could not cache the org's metadata in {}: {}".format(
+                self._org_metadata_path, e))
+
+    def _get_package_versions(self):
+        """ Returns the version of each package installed in the org, by
+            namespace prefix
+        """
+        result = self.cumulusci.tooling.query(
+            "SELECT SubscriberPackage.NamespacePrefix, "
+            "SubscriberPackageVersion.MajorVersion, "
+            "SubscriberPackageVersion.MinorVersion, "
+            "SubscriberPackageVersion.PatchVersion, "
+            "SubscriberPackageVersion.BuildNumber "
+            "FROM InstalledSubscriberPackage")
+        return {
+            # Unmanaged packages have no prefix, which JSON can't have
+            # as a key, so "" stands for it
+            record["SubscriberPackage"]["NamespacePrefix"] or "":
+                "{MajorVersion}.{MinorVersion}.{PatchVersion}.{BuildNumber}".format(
+                    **record["SubscriberPackageVersion"])
+            for record in result["records"]
+        }
+
+    def _start_suite(self, name, attrs):
+        self._suite_wait_times[attrs["longname"]] = self._wait_time
+
+    def _end_suite(self, name, attrs):
+        wait_time = self._wait_time - self._suite_wait_times.pop(attrs["longname"], 0.0)
+        logger.info(
+            "Time spent waiting in suite {}: {:.1f}s".format(attrs["longname"], wait_time),
+            also_console=True)
+
+    def _wait_until(self, condition, message, timeout=WAIT_TIMEOUT):
+        """ Waits for Aura to finish any requests in flight and calls
+            condition, until condition returns a true value, which is
+            returned.  Raises AssertionError with message if it hasn't after
+            timeout seconds.  The time spent counts towards the time the
+            suite spends waiting.
+        """
+        start = time.time()
+        try:
+            while True:
+                self.wait_for_aura()
+                try:
+                    result = condition()
+                except (StaleElementReferenceException, ElementNotFound):
+                    result = None
+                if result:
+                    return result
+                if time.time() - start > timeout:
+                    raise AssertionError(message)
+                time.sleep(WAIT_INTERVAL)
+        finally:
+            self._wait_time += time.time() - start
+
+    def _is_visible(self, locator):
+        return any(element.is_displayed() for element in self.selenium.get_webelements(locator))
+
+    def _is_stale(self, element):
+        try:
+            element.is_enabled()
+        except StaleElementReferenceException:
+            return True
+        return False
+
+    def _wait_until_loaded(self, message, timeout=WAIT_TIMEOUT):
+        self._wait_until(lambda: not self._is_visible(npsp_lex_locators["spinner"]),
+                         message, timeout)
+
+    def _wait_for_suggestions(self, field):
+        """ Waits until a lookup field has opened its list of suggestions
+            for the text typed into it.  Other fields only wait for the page
+            to finish loading.
+        """
+        self._wait_until(
+            lambda: field.get_attribute("aria-expanded") != "false"
+                and not self._is_visible(npsp_lex_locators["spinner"]),
+            "Timed out waiting for suggestions for {}".format(field.get_attribute("placeholder")))
+
+    def _wait_for_menu(self, locator):
+        self._wait_until(lambda: self._is_visible(npsp_lex_locators["menu"]),
+                         "Timed out waiting for the menu of {} to open".format(locator))
+
+    def _wait_for_selection(self, locator, value):
+        """ Waits until value is selected in the list and the page has
+            finished responding to the change
+        """
+        self._wait_until(
+            lambda: self.selenium.get_selected_list_label(locator) == value
+                and not self._is_visible(npsp_lex_locators["spinner"]),
+            "Timed out waiting for {} to be selected in {}".format(value, locator))
+
     def populate_field_by_placeholder(self, loc, value):
         """ Populate field with Place Holder as a locator
             and actual value of the place holder.
@@ -100,20 +355,25 @@ class NPSP(object):
 #         self.salesforce._populate_field(xpath, value)
         
         field.send_keys(value)
-        time.sleep(2)
+        self._wait_for_suggestions(field)
 # #         if loc == ("Search Contacts" or "Search Accounts"):
 #         field.send_keys(Keys.ENTER)
 # #             field.send_keys(Keys.ARROW_DOWN)
         field.send_keys(Keys.ENTER)
 
-    def click_record_button(self, title):
+    def click_record_button(self, title, wait_until_gone=False):
         """ Pass title of the button to click the buttons on the records edit page. Usually save and cancel are the buttons seen.
+            Waits for the page to finish loading, and with wait_until_gone=True
+            also for the button to go away, as an inline edit's Save does.
         """
         locator = npsp_lex_locators['record']['button'].format(title)
         self.selenium.set_focus_to_element(locator)
         button = self.selenium.get_webelement(locator)
         button.click()
-        time.sleep(5)
+        if is_truthy(wait_until_gone):
+            self._wait_until(lambda: self._is_stale(button) or not self._is_visible(locator),
+                             "Timed out waiting for {} to finish".format(title))
+        self._wait_until_loaded("Timed out waiting for {} to finish".format(title))
         
     def select_tab(self, title):
         """ Switch between different tabs on a record page like Related, Details, News, Activity and Chatter
@@ -127,7 +387,11 @@ class NPSP(object):
                 self.selenium.set_focus_to_element(locator)
                 button = self.selenium.get_webelement(locator)
                 button.click()
-                time.sleep(5)
+                self._wait_until(
+                    lambda: self._is_visible(
+                        "{}/ancestor-or-self::*[@aria-selected='true']".format(locator)),
+                    "Timed out waiting for tab {} to be selected".format(title))
+                self._wait_until_loaded("Timed out waiting for tab {} to load".format(title))
                 tab_found = True
                 break
 
@@ -148,7 +412,6 @@ class NPSP(object):
         self.salesforce.load_related_list(heading)
         locator = npsp_lex_locators["record"]["related"]["button"].format(heading, dd_title)
         self.selenium.click_link(locator) 
-        time.sleep(1)
         loc=npsp_lex_locators["record"]["related"]["dd-link"].format(button_title)
         self.selenium.wait_until_element_is_visible(loc)
         self.selenium.click_link(loc)   
@@ -206,7 +469,7 @@ class NPSP(object):
             if element.text == value:
                 drop_down = npsp_lex_locators['locate_dropdown'].format(index + 1)
                 self.selenium.get_webelement(drop_down).click()
-                time.sleep(1)
+                self._wait_for_menu(drop_down)
 
     def select_related_row(self, value):
         """To select a row on object page based on name and open the dropdown"""
@@ -216,7 +479,7 @@ class NPSP(object):
             if element.text == value:
                 drop_down = npsp_lex_locators['rel_loc_dd'].format(index + 1)
                 self.selenium.get_webelement(drop_down).click()
-                time.sleep(1)
+                self._wait_for_menu(drop_down)
 #     def select_row(self, value ):
 #         """To select a row on object page based on name and open the dropdown"""
 #         locators = npsp_lex_locators['name']
@@ -590,21 +853,21 @@ class NPSP(object):
             loc = self.selenium.get_webelement(locator)
             self.selenium.set_focus_to_element(locator)       
             self.selenium.select_from_list_by_label(loc,value)
-            time.sleep(2)
+            self._wait_for_selection(locator, value)
         elif name == "Source Field":
             id = "fldSourceField"
             locator = npsp_lex_locators['levels']['select'].format(id)
             loc = self.selenium.get_webelement(locator) 
             self.selenium.set_focus_to_element(locator)      
             self.selenium.select_from_list_by_label(loc,value) 
-            time.sleep(2) 
+            self._wait_for_selection(locator, value)
         elif name == "Level Field":
             id = "fldLevel"
             locator = npsp_lex_locators['levels']['select'].format(id)
             loc = self.selenium.get_webelement(locator) 
             self.selenium.set_focus_to_element(locator)      
             self.selenium.select_from_list_by_label(loc,value)
-            time.sleep(2)
+            self._wait_for_selection(locator, value)
         elif name == "Previous Level Field":
             id = "fldPreviousLevel"
             locator = npsp_lex_locators['levels']['select'].format(id)
@@ -615,13 +878,16 @@ class NPSP(object):
     def select_app_launcher_link(self,title):
         locator = npsp_lex_locators['app_launcher']['select-option'].format(title) 
         self.selenium.get_webelement(locator).click()
-        time.sleep(1)
+        self._wait_until(lambda: not self._is_visible(locator),
+                         "Timed out waiting for the app launcher to open {}".format(title))
         
     def click_on_first_record(self):  
         """selects first record of the page"""
         locator = npsp_lex_locators['select_one_record']
         self.selenium.get_webelement(locator).click()
-        time.sleep(1)  
+        self._wait_until(lambda: not self._is_visible(locator),
+                         "Timed out waiting for the first record to open")
+        self.salesforce.wait_until_loading_is_complete()
         
     def select_search(self, index, value):
         """"""
@@ -629,7 +895,7 @@ class NPSP(object):
         loc_value = self.selenium.get_webelement(locator).send_keys(value)
         loc = self.selenium.get_webelement(locator)
         #loc.send_keys(Keys.TAB+ Keys.RETURN)
-        time.sleep(1)  
+        self._wait_for_suggestions(loc)
         
     def enter_gau(self, value):
         id = "lksrch"
@@ -637,7 +903,11 @@ class NPSP(object):
         loc = self.selenium.get_webelement(locator)
         loc.send_keys(value)
         self.selenium.get_webelement("//*[@title='Go!']").click()
-        time.sleep(1)
+        self._wait_until(lambda: self._is_stale(loc),
+                         "Timed out waiting for search results for {}".format(value))
+        self._wait_until(
+            lambda: self.selenium.execute_javascript("return document.readyState") == "complete",
+            "Timed out waiting for search results for {}".format(value))
 
     def add_gau_allocation(self,field, value):
         locator = npsp_lex_locators["gaus"]["input_field"].format(field)
@@ -660,7 +930,7 @@ class NPSP(object):
             loc = self.selenium.get_webelement(locator)
             self.selenium.set_focus_to_element(locator)       
             self.selenium.select_from_list_by_label(loc,args[i])
-            time.sleep(2)    
+            self._wait_for_selection(locator, args[i])
                 
     def verify_payment_split(self, amount, no_payments):
         loc = "//*[@id='pmtTable']/tbody/tr/td[2]/div//input[@value= '{}']"
@@ -817,21 +1087,13 @@ class NPSP(object):
         
         
     def wait_for_batch_to_complete(self, path, *args, **kwargs):
-        """Checks every 15 secs for upto 3.5mins for batch with given status
+        """Waits for upto 3.5mins for batch with given status
         """
-        i = 0
         locator = self.get_npsp_locator(path,*args, **kwargs)
-        while True:
-            i += 1
-            if i > 14:
-                raise AssertionError(
-                    "Timed out waiting for batch with locator {} to load.".format(locator)
-                )
-            try:
-                self.selenium.wait_until_element_is_visible(locator)
-                break
-            except ElementNotFound:
-                time.sleep(15)    
+        self._wait_until(
+            lambda: self._is_visible(locator),
+            "Timed out waiting for batch with locator {} to load.".format(locator),
+            timeout=210)
 
     def get_npsp_settings_value(self,field_name): 
         locator = npsp_lex_locators['npsp_settings']['field_value'].format(field_name)
@@ -900,8 +1162,10 @@ class NPSP(object):
         self.builtin.log("This test is using javascript to click on button as regular click wouldn't work with Summer19", "WARN")    
         locator=npsp_lex_locators['bge']['button'].format(text)
         self.selenium.set_focus_to_element(locator)
-        time.sleep(1)
-        element = self.selenium.driver.find_element_by_xpath(locator)
+        element = self._wait_until(
+            lambda: next((element for element in self.selenium.get_webelements(locator)
+                          if element.is_displayed() and element.is_enabled()), None),
+            "Timed out waiting for button {} to be enabled".format(text))
         self.selenium.driver.execute_script('arguments[0].click()', element)
   
            
@@ -959,7 +1223,7 @@ class NPSP(object):
             if element.text == value:
                 drop_down = npsp_lex_locators['bge']['locate_dropdown'].format(index+1)
                 self.selenium.click_element(drop_down)
-                time.sleep(1)
+                self._wait_for_menu(drop_down)
 
     def click_link_with_text(self, text):
         self.builtin.log("This test is using the 'Click link with text' workaround", "WARN")
@@ -968,12 +1232,8 @@ class NPSP(object):
     
     def verify_expected_batch_values(self, batch_id,**kwargs):
         """To verify that the data in Data Import Batch matches expected value provide batch_id and the data u want to verify"""    
-        ns=self.get_npsp_namespace_prefix()
-        table=ns + "DataImportBatch__c"
-        bge_batch=self.salesforce.salesforce_get(table,batch_id)
-        for key, value in kwargs.items():
-            label=ns + key
-            self.builtin.should_be_equal_as_strings(bge_batch[label], value)
+        table=self.get_npsp_object_name("DataImportBatch__c")
+        self.verify_expected_values_for_records(table, [batch_id], **kwargs)
             
     def click_element_with_locator(self, path, *args, **kwargs):
         """Pass the locator and its values for the element you want to click """
@@ -981,39 +1241,31 @@ class NPSP(object):
         self.selenium.click_element(locator)      
             
     def wait_for_record_to_update(self, id, value):
-        """Waits for specified record header to be updated by checking every second for 10 times.
+        """Waits for upto 10 secs for specified record header to be updated, reloading the record until it is.
         """
-        i = 0
-        while True:
-            i += 1
-            if i > 10:
-                raise AssertionError(
-                    "Timed out waiting for record name to be {} .".format(value)
-                )
+        def header_updated():
             self.salesforce.go_to_record_home(id)
             try:
                 self.verify_header(value)
-                break
             except Exception:
-                time.sleep(1)
+                return False
+            return True
+        self._wait_until(
+            header_updated,
+            "Timed out waiting for record name to be {} .".format(value),
+            timeout=10)
                      
     def load_locator(self, locator):
         """Scrolls down until the specified locator is found.
         """
-        i = 0
-        while True:
-            i += 1
-            if i > 20:
-                raise AssertionError(
-                    "Timed out waiting for locator {} to load.".format(locator)
-                )
-            self.selenium.execute_javascript("window.scrollBy(0, 100)")
-            self.wait_for_aura()
-            try:
-                self.selenium.get_webelement(locator)
-                break
-            except ElementNotFound:
-                time.sleep(0.2)
+        def scrolled_to_locator():
+            if self.check_if_element_exists(locator):
+                return True
+            self.selenium.execute_javascript("window.scrollBy(0, window.innerHeight / 2)")
+            return False
+        self._wait_until(
+            scrolled_to_locator,
+            "Timed out waiting for locator {} to load.".format(locator))
                         
     def select_multiple_values_from_duellist(self,path,list_name,section,*args): 
         """Pass the list name and values to be selected from the dropdown. """
@@ -1046,14 +1298,55 @@ class NPSP(object):
        provide ns if object has namespace prefix otherwise nonns,
        object api name, record_id and the data u want to verify"""    
        if(ns_ind=='ns'):
-           ns=self.get_npsp_namespace_prefix()
-           table=ns + "DataImportBatch__c"
+           table=self.get_npsp_object_name("DataImportBatch__c")
        else:
             table=obj_api
        rec=self.salesforce.salesforce_get(table,rec_id)
        for key, value in kwargs.items():
            self.builtin.should_be_equal_as_strings(rec[key], value)
 
+    def verify_expected_values_for_records(self, obj_api, records, key_field="Id", **kwargs):
+        """ Verifies that the records of the object whose key_field, Id by
+            default, has one of the values in the records list have the
+            expected field values, given as field=value.  Field names get
+            the NPSP namespace prefix where the object's fields have it.
+            The records are fetched 200 at a time and every mismatch, and
+            every record that wasn't found, is reported in one failure.
+        """
+        if isinstance(records, str):
+            records = [records]
+        key_field = self.get_npsp_field_name(obj_api, key_field)
+        # Ids may be given in their 15 or 18 character forms
+        normalize = (lambda key: str(key)[:15]) if key_field == "Id" else str
+        keys = list(dict.fromkeys(normalize(record) for record in records))
+        fields = {self.get_npsp_field_name(obj_api, key): str(value)
+                  for key, value in kwargs.items()}
+        found = set()
+        errors = []
+        queries = 0
+        for start in range(0, len(keys), VERIFY_CHUNK_SIZE):
+            chunk = keys[start:start + VERIFY_CHUNK_SIZE]
+            result = self.cumulusci.sf.query_all(
+                "SELECT {} FROM {} WHERE {} IN ({})".format(
+                    ", ".join(dict.fromkeys(["Id", key_field] + list(fields))),
+                    obj_api, key_field,
+                    ", ".join("'{}'".format(key.replace("\\", "\\\\").replace("'", "\\'"))
+                              for key in chunk)))
+            queries += 1
+            for record in result["records"]:
+                key = normalize(record[key_field])
+                found.add(key)
+                for field, expected in fields.items():
+                    if str(record[field]) != expected:
+                        errors.append("{} {}: {} is '{}', expected '{}'".format(
+                            obj_api, key, field, record[field], expected))
+        errors.extend("{} {}: not found".format(obj_api, key) for key in keys if key not in found)
+        self.builtin.log("Verified {} {} records with {} queries".format(
+            len(found), obj_api, queries))
+        if errors:
+            raise AssertionError("Found {} problems verifying {} {} records:\n{}".format(
+                len(errors), len(keys), obj_api, "\n".join(errors)))
+
     def get_org_namespace_prefix(self):
         if self.cumulusci.org.namespaced:
             return "npsp__" 
@@ -1103,10 +1396,66 @@ class NPSP(object):
                 {"options": {"apex" : code}}
         )
 
+        previous_job_id = self.get_latest_apex_job_id("BDI_DataImport_BATCH")
         self.cumulusci._run_task(AnonymousApexTask, subtask_config)
+        return self.wait_for_apex_job_to_complete("BDI_DataImport_BATCH", previous_job_id)
 
-        subtask_config = TaskConfig(
-                {"options": {"class_name" : "BDI_DataImport_BATCH"}}
-        )
+    def get_latest_apex_job_id(self, class_name):
+        """ Returns the Id of the latest batch job for the apex class, or
+            None if it has never run
+        """
+        job = self._get_latest_apex_job(class_name)
+        return job["Id"] if job else None
+
+    def wait_for_apex_job_to_complete(self, class_name, previous_job_id=None, timeout=APEX_JOB_TIMEOUT):
+        """ Polls AsyncApexJob through the API until the latest batch job for
+            the apex class, unless it is previous_job_id, has finished, and
+            fails if the job failed, was aborted or had errors.  The time
+            between polls grows from 1 to 30 secs.  Logs and returns the
+            time the job took in secs.
+
+            No browser is needed, so this can be used after an import is
+            started through the API or from the BGE page.
+        """
+        start = time.time()
+        interval = APEX_JOB_POLL_INTERVAL
+        try:
+            while True:
+                job = self._get_latest_apex_job(class_name)
+                if (job and job["Id"] != previous_job_id
+                        and job["Status"] in APEX_JOB_FINISHED_STATUSES):
+                    break
+                remaining = float(timeout) - (time.time() - start)
+                if remaining <= 0:
+                    raise AssertionError(
+                        "Timed out waiting for {} job to complete.".format(class_name))
+                time.sleep(min(interval * random.uniform(0.5, 1), remaining))
+                interval = min(interval * 2, APEX_JOB_MAX_POLL_INTERVAL)
+        finally:
+            self._wait_time += time.time() - start
+        # A failed or aborted job may have no CompletedDate
+        duration = None
+        if job["CompletedDate"]:
+            duration = (parse_api_datetime(job["CompletedDate"])
+                        - parse_api_datetime(job["CreatedDate"])).total_seconds()
+        self.builtin.log(
+            "{} job {} {}{}, {:.1f}s after waiting began: "
+            "{} of {} batches processed with {} errors".format(
+                class_name, job["Id"], job["Status"].lower(),
+                "" if duration is None else " in {:.0f}s".format(duration),
+                time.time() - start,
+                job["JobItemsProcessed"], job["TotalJobItems"], job["NumberOfErrors"]))
+        if job["Status"] != "Completed" or job["NumberOfErrors"]:
+            raise AssertionError("{} job {} {} with {} errors. {}".format(
+                class_name, job["Id"], job["Status"].lower(), job["NumberOfErrors"],
+                job["ExtendedStatus"] or ""))
+        return duration
 
-        self.cumulusci._run_task(BatchApexWait, subtask_config)
+    def _get_latest_apex_job(self, class_name):
+        result = self.cumulusci.sf.query(
+            "SELECT Id, Status, ExtendedStatus, TotalJobItems, JobItemsProcessed, "
+            "NumberOfErrors, CreatedDate, CompletedDate "
+            "FROM AsyncApexJob "
+            "WHERE JobType = 'BatchApex' AND ApexClass.Name = '{}' "
+            "ORDER BY CreatedDate DESC LIMIT 1".format(class_name))
+        return result["records"][0] if result["records"] else None
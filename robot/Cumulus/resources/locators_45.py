@@ -17,6 +17,8 @@ npsp_lex_locators.update({
     'tabs':{   
         'tab': "//div[@class='uiTabBar']/ul[@class='tabs__nav']/li[contains(@class,'uiTabItem')]/a[@class='tabHeader']/span[contains(text(), '{}')]",
     },
+    'spinner': 'css: div.slds-spinner',
+    'menu': "//*[@role='menu']",
     'detail_page': {
         'field-value':{
                 'verify_field_value1':'//div[contains(@class, "forcePageBlockItem")]/div/div//span[text()="{}"]/../../div[2]/span/span[text() = "{}"]',
@@ -59,6 +59,7 @@ npsp_lex_locators={
     'desktop_rendered': 'css: div.desktop.container.oneOne.oneAppLayoutHost[data-aura-rendered-by]',
     'loading_box': 'css: div.auraLoadingBox.oneLoadingBox',
     'spinner': 'css: div.slds-spinner',
+    'menu': "//*[@role='menu']",
     'modal_field':"//div[contains(@class, 'lookupInput')][./label[contains(text(), '{}')]]/div//span[@class='lookupInput']/input",
     'name':'//tbody/tr/th/span/a',
     'select_name':'//tbody//a[text()= "{}"]',
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""Time the options GenerateBDIData offers for large benchmark datasets.
+Run it from the repository root with CumulusCI installed:
+
+    python scripts/bdi_benchmark.py storage --num-records 10000 100000 1000000
+    python scripts/bdi_benchmark.py pipeline --num-records 200000
+    python scripts/bdi_benchmark.py index --num-records 1000000
+
+storage times generation into a database with each storage_mode.
+pipeline times a sequential and a pipelined generate-and-load, and the
+time of the first Bulk API batch.  index times LoadData's query for each
+mapping step with lookups with and without index_lookups' indexes, over a
+database whose id tables are filled as if every record were loaded.
+
+No org is needed: loads go to the mock Bulk API in tasks/tests/bulk_api.py.
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from cumulusci.core.config import OrgConfig  # noqa: E402
+from cumulusci.core.config import TaskConfig  # noqa: E402
+from cumulusci.tasks.salesforce import BaseSalesforceTask  # noqa: E402
+from cumulusci.tests.util import create_project_config  # noqa: E402
+from cumulusci.utils import temporary_dir  # noqa: E402
+
+from tasks.generate_bdi_data import STORAGE_MODES  # noqa: E402
+from tasks.generate_bdi_data import GenerateBDIData  # noqa: E402
+from tasks.generate_bdi_data import PipelinedLoadData  # noqa: E402
+from tasks.generate_bdi_data import Timings  # noqa: E402
+from tasks.generate_bdi_data import create_lookup_indexes  # noqa: E402
+from tasks.tests.bulk_api import MockBulkAPI  # noqa: E402
+from tasks.tests.bulk_api import MockSalesforce  # noqa: E402
+
+MAPPING = os.path.join(ROOT, "datasets", "bdi_benchmark", "mapping.yml")
+
+
+def org_config():
+    """Tasks need an org to be constructed, but nothing here connects to it"""
+    return OrgConfig(
+        {"instance_url": "https://example.my.salesforce.com", "access_token": "TOKEN"},
+        "benchmark",
+    )
+
+
+def make_task(**options):
+    options = dict({"mapping_yaml": MAPPING}, **options)
+    task = GenerateBDIData(
+        create_project_config(), TaskConfig({"options": options}), org_config()
+    )
+    task.timings = Timings()
+    return task
+
+
+def generate(path, **options):
+    """Generate the database at path, returning the task and its seconds"""
+    task = make_task(**options)
+    start = time.time()
+    task._generate_data("sqlite:///" + path, MAPPING)
+    return task, time.time() - start
+
+
+def benchmark_storage(args):
+    print("records " + "".join("{:>10}".format(mode) for mode in STORAGE_MODES))
+    for num_records in args.num_records:
+        seconds = []
+        for storage_mode in STORAGE_MODES:
+            with temporary_dir() as tempdir:
+                _, elapsed = generate(
+                    os.path.join(tempdir, "generated.db"),
+                    num_records=num_records,
+                    insert_mode=args.insert_mode,
+                    chunk_size=args.chunk_size,
+                    storage_mode=storage_mode,
+                )
+            seconds.append(elapsed)
+        print(
+            "{:<8}".format(num_records)
+            + "".join("{:>9.2f}s".format(elapsed) for elapsed in seconds)
+        )
+
+
+def benchmark_pipeline(args):
+    print("records  mode          first batch      total")
+    for num_records in args.num_records:
+        for pipeline in (False, True):
+            with temporary_dir() as tempdir, MockBulkAPI(args.post_delay) as api:
+                task = make_task(
+                    num_records=num_records,
+                    insert_mode=args.insert_mode,
+                    debug_db_path=os.path.join(tempdir, "generated.db"),
+                    pipeline=pipeline,
+                )
+                with mock.patch.object(
+                    BaseSalesforceTask, "_update_credentials"
+                ), mock.patch.object(
+                    PipelinedLoadData, "_init_bulk", return_value=api
+                ), mock.patch.object(
+                    PipelinedLoadData, "_init_api", return_value=MockSalesforce()
+                ):
+                    task()
+                total = time.time() - api.start_time
+            first = min(event[0] for event in api.events if event[1] == "post batch")
+            print(
+                "{:<8} {:<12} {:>11.2f}s {:>9.2f}s".format(
+                    num_records, "pipelined" if pipeline else "sequential", first, total
+                )
+            )
+
+
+def fill_id_tables(path, mappings):
+    """Give every row an id table entry, as a complete load would"""
+    connection = sqlite3.connect(path)
+    try:
+        for table in {mapping["table"] for mapping in mappings.values()}:
+            connection.execute(
+                'CREATE TABLE "{}_sf_ids" '
+                "(id VARCHAR(255) NOT NULL PRIMARY KEY, sf_id VARCHAR(18))".format(
+                    table
+                )
+            )
+            connection.execute(
+                'INSERT INTO "{0}_sf_ids" '
+                "SELECT id, printf('001%015d', id) FROM \"{0}\"".format(table)
+            )
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def make_loader(path):
+    loader = PipelinedLoadData(
+        create_project_config(),
+        TaskConfig(
+            {"options": {"database_url": "sqlite:///" + path, "mapping": MAPPING}}
+        ),
+        org_config(),
+    )
+    loader._init_mapping()
+    loader._init_db()
+    for mapping in loader.mapping.values():
+        mapping["oid_as_pk"] = bool(mapping.get("fields", {}).get("Id"))
+    return loader
+
+
+def time_query(loader, mapping):
+    """The query plan, and the seconds to the first row and to the last"""
+    query = loader._query_db(mapping)
+    statement = query.statement.compile(compile_kwargs={"literal_binds": True})
+    plan = [
+        row[-1]
+        for row in loader.session.execute("EXPLAIN QUERY PLAN {}".format(statement))
+    ]
+    start = time.time()
+    rows = iter(query.yield_per(10000))
+    next(rows, None)
+    first = time.time() - start
+    for _ in rows:
+        pass
+    return plan, first, time.time() - start
+
+
+def benchmark_index(args):
+    with temporary_dir() as tempdir:
+        path = os.path.join(tempdir, "generated.db")
+        task, elapsed = generate(
+            path, num_records=args.num_records, insert_mode=args.insert_mode
+        )
+        print("Generated {} records in {:.2f}s".format(args.num_records, elapsed))
+        fill_id_tables(path, task.mappings)
+        for indexed in (False, True):
+            loader = make_loader(path)
+            if indexed:
+                start = time.time()
+                for mapping in loader.mapping.values():
+                    create_lookup_indexes(mapping, loader.metadata, loader.engine)
+                print("Indexed lookups in {:.2f}s".format(time.time() - start))
+            for name, mapping in loader.mapping.items():
+                if not mapping.get("lookups"):
+                    continue
+                plan, first, total = time_query(loader, mapping)
+                print(
+                    "{} {}: first row {:.2f}s, all rows {:.2f}s".format(
+                        "indexed" if indexed else "unindexed", name, first, total
+                    )
+                )
+                for detail in plan:
+                    print("    " + detail)
+            loader.session.close()
+            loader.engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--insert-mode", default="bulk")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    storage = subparsers.add_parser("storage")
+    storage.add_argument(
+        "--num-records", type=int, nargs="+", default=[10000, 100000, 1000000]
+    )
+    storage.add_argument("--chunk-size", type=int, default=10000)
+    storage.set_defaults(run=benchmark_storage)
+
+    pipeline = subparsers.add_parser("pipeline")
+    pipeline.add_argument("--num-records", type=int, nargs="+", default=[200000])
+    pipeline.add_argument(
+        "--post-delay",
+        type=float,
+        default=0,
+        help="Seconds the mock Bulk API takes to accept each batch",
+    )
+    pipeline.set_defaults(run=benchmark_pipeline)
+
+    index = subparsers.add_parser("index")
+    index.add_argument("--num-records", type=int, default=1000000)
+    index.set_defaults(run=benchmark_index)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
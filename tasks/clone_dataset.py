@@ -0,0 +1,142 @@
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from cumulusci.core.tasks import BaseTask
+from cumulusci.core.exceptions import TaskOptionsError
+from cumulusci.core.utils import ordered_yaml_load
+
+from tasks.generate_bdi_data import attached_table
+from tasks.generate_bdi_data import copy_ddl
+from tasks.generate_bdi_data import get_lookup_key_field
+
+
+class CloneDataset(BaseTask):
+    task_docs = """
+    Build a larger dataset by cloning every table of a seed dataset, such as
+    datasets/1k/test_data.db, `copies` times inside SQLite.  Each copy's
+    primary keys, and the lookup columns in the mapping file, are offset
+    past the previous copy's, and its `suffix_fields` get the copy number
+    appended so that they stay unique.  The first copy is the seed itself,
+    so the result has the seed's relationships at `copies` times its size.
+    """
+
+    task_options = {
+        "seed_db": {
+            "description": "The dataset database to clone. Defaults to datasets/1k/test_data.db.",
+            "required": False,
+        },
+        "mapping": {"description": "The mapping file the seed database is loaded with", "required": True},
+        "database": {"description": "The path to write the cloned dataset to", "required": True},
+        "copies": {"description": "How many copies of the seed to make", "required": True},
+        "suffix_fields": {
+            "description": "The Salesforce fields whose values get the copy number appended. "
+            "Defaults to Name and LastName.",
+            "required": False,
+        },
+    }
+
+    def _init_options(self, kwargs):
+        super(CloneDataset, self)._init_options(kwargs)
+        self.options["seed_db"] = self.options.get("seed_db") or os.path.join(
+            "datasets", "1k", "test_data.db"
+        )
+        if not os.path.isfile(self.options["seed_db"]):
+            raise TaskOptionsError("No database at {}".format(self.options["seed_db"]))
+        if os.path.exists(self.options["database"]):
+            raise TaskOptionsError(
+                "{} already exists; delete it first.".format(self.options["database"])
+            )
+        self.options["copies"] = int(self.options["copies"])
+        if self.options["copies"] < 1:
+            raise TaskOptionsError("copies must be at least 1")
+        suffix_fields = self.options.get("suffix_fields") or ["Name", "LastName"]
+        if isinstance(suffix_fields, str):
+            suffix_fields = [field.strip() for field in suffix_fields.split(",")]
+        self.options["suffix_fields"] = suffix_fields
+
+    def _run_task(self):
+        with open(self.options["mapping"], "r") as f:
+            mappings = ordered_yaml_load(f)
+        start = time.perf_counter()
+        rows = clone_dataset(
+            self.options["seed_db"],
+            self.options["database"],
+            mappings,
+            self.options["copies"],
+            self.options["suffix_fields"],
+        )
+        self.logger.info(
+            "Wrote {} copies of {}, {} rows, to {} in {:.2f}s".format(
+                self.options["copies"],
+                self.options["seed_db"],
+                rows,
+                self.options["database"],
+                time.perf_counter() - start,
+            )
+        )
+
+
+def clone_dataset(seed_path, path, mappings, copies, suffix_fields=()):
+    """Write copies of every mapping table in the SQLite database at
+       seed_path to a new database at path, with one INSERT ... SELECT per
+       table, and return the number of rows written"""
+    tables = OrderedDict()
+    for mapping in mappings.values():
+        table = tables.setdefault(mapping["table"], {"lookups": {}, "suffixes": set()})
+        for sf_field, lookup in mapping.get("lookups", {}).items():
+            table["lookups"][get_lookup_key_field(lookup, sf_field)] = lookup["table"]
+        for sf_field, column in mapping.get("fields", {}).items():
+            if sf_field in suffix_fields:
+                table["suffixes"].add(column)
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute("ATTACH DATABASE ? AS seed", (seed_path,))
+        offsets = {}
+        for name, table in tables.items():
+            table["columns"], table["key"] = attached_table(connection, "seed", name)
+            # Each copy's keys start after the largest key in the seed
+            offsets[name] = next(
+                connection.execute(
+                    'SELECT COALESCE(MAX("{}"), 0) FROM seed."{}"'.format(table["key"], name)
+                )
+            )[0]
+        with connection:
+            copy_ddl(connection, "seed", tables, "table")
+            # cursor.rowcount isn't set for statements that start with WITH
+            changes = connection.total_changes
+            for name, table in tables.items():
+                terms = []
+                for column in table["columns"]:
+                    quoted = 'seed_table."{}"'.format(column)
+                    if column == table["key"] or column in table["lookups"]:
+                        offset = offsets[table["lookups"].get(column, name)]
+                        terms.append(
+                            "CASE WHEN c = 0 OR {0} IS NULL OR {0} = '' THEN {0} "
+                            "ELSE {0} + c * {1} END".format(quoted, int(offset))
+                        )
+                    elif column in table["suffixes"]:
+                        terms.append(
+                            "CASE WHEN c = 0 OR {0} IS NULL THEN {0} "
+                            "ELSE {0} || ' ' || c END".format(quoted)
+                        )
+                    else:
+                        terms.append(quoted)
+                # CROSS JOIN makes SQLite loop over copies on the outside,
+                # so the rows are written a whole copy at a time
+                connection.execute(
+                    "WITH RECURSIVE copies(c) AS "
+                    "(SELECT 0 UNION ALL SELECT c + 1 FROM copies WHERE c + 1 < ?) "
+                    'INSERT INTO main."{0}" ({1}) SELECT {2} '
+                    'FROM copies CROSS JOIN seed."{0}" AS seed_table'.format(
+                        name,
+                        ", ".join('"{}"'.format(column) for column in table["columns"]),
+                        ", ".join(terms),
+                    ),
+                    (copies,),
+                )
+            rows = connection.total_changes - changes
+            copy_ddl(connection, "seed", tables, "index")
+        return rows
+    finally:
+        connection.close()
@@ -0,0 +1,195 @@
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from cumulusci.core.tasks import BaseTask
+from cumulusci.core.exceptions import TaskOptionsError
+from cumulusci.core.utils import ordered_yaml_load
+from datetime import datetime
+
+from tasks.generate_bdi_data import LOAD_BATCH_SIZE
+from tasks.generate_bdi_data import fields_for_mapping
+from tasks.generate_bdi_data import load_filters
+from tasks.generate_bdi_data import load_order
+from tasks.load_csv_batches import step_directory
+
+
+class ExportCSVBatches(BaseTask):
+    task_docs = """
+    Export the records of a dataset database to gzipped CSV batches, in the
+    layout LoadCSVBatches uploads: one directory per mapping step, with the
+    rows LoadData would query for that step, in the same order.  Each step is
+    exported by its own worker process.  A manifest.json next to the step
+    directories records the row count and SHA-256 of every batch file along
+    with the checksums of the database and mapping they were exported from,
+    so that the batches can be reused until either changes.
+    """
+
+    task_options = {
+        "database": {"description": "The SQLite dataset database to export", "required": True},
+        "mapping": {"description": "The mapping file to export the database with", "required": True},
+        "csv_dir": {"description": "The directory to write CSV batches to", "required": True},
+        "batch_size": {
+            "description": "The number of records in each batch file. Defaults to 10000.",
+            "required": False,
+        },
+        "workers": {
+            "description": "Number of processes to export mapping steps with. Defaults to the number of CPUs.",
+            "required": False,
+        },
+    }
+
+    def _init_options(self, kwargs):
+        super(ExportCSVBatches, self)._init_options(kwargs)
+        self.options["batch_size"] = int(self.options.get("batch_size") or LOAD_BATCH_SIZE)
+        self.options["workers"] = int(self.options.get("workers") or os.cpu_count() or 1)
+        if not os.path.isfile(self.options["database"]):
+            raise TaskOptionsError("No database at {}".format(self.options["database"]))
+
+    def _run_task(self):
+        with open(self.options["mapping"], "r") as f:
+            mappings = ordered_yaml_load(f)
+        csv_dir = self.options["csv_dir"]
+        start = time.perf_counter()
+        with ProcessPoolExecutor(self.options["workers"]) as executor:
+            futures = [
+                executor.submit(
+                    export_step,
+                    self.options["database"],
+                    os.path.join(csv_dir, step_directory(index, name)),
+                    mapping,
+                    self.options["batch_size"],
+                )
+                for index, (name, mapping) in enumerate(mappings.items())
+            ]
+            steps = []
+            for name, future in zip(mappings, futures):
+                step = OrderedDict([("name", name)])
+                step.update(future.result())
+                self.logger.info(
+                    "Exported {}: {} rows in {} batches".format(
+                        name, step["rows"], len(step["batches"])
+                    )
+                )
+                steps.append(step)
+        manifest = OrderedDict(
+            [
+                ("database", os.path.basename(self.options["database"])),
+                ("database_sha256", file_sha256(self.options["database"])),
+                ("mapping", os.path.basename(self.options["mapping"])),
+                ("mapping_sha256", file_sha256(self.options["mapping"])),
+                ("batch_size", self.options["batch_size"]),
+                ("steps", steps),
+            ]
+        )
+        with open(os.path.join(csv_dir, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+        self.logger.info(
+            "Exported {} rows in {:.2f}s".format(
+                sum(step["rows"] for step in steps), time.perf_counter() - start
+            )
+        )
+
+
+def export_step(database, directory, mapping, batch_size=LOAD_BATCH_SIZE):
+    """Write the rows LoadData would query from a dataset database for one
+       mapping step to gzipped CSV batches, in the layout CSVStepWriter
+       writes, and describe the files written"""
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    connection = sqlite3.connect(database)
+    try:
+        table = mapping["table"]
+        columns = OrderedDict(
+            (row[1], row)
+            for row in connection.execute('PRAGMA table_info("{}")'.format(table))
+        )
+        key = next(name for name, row in columns.items() if row[5])
+        fields = [
+            field
+            for field in fields_for_mapping(mapping)
+            if field["sf"] != "Id" or mapping.get("action") == "update"
+        ]
+        dates = [False] + ["DATE" in columns[field["db"]][2].upper() for field in fields]
+        query = 'SELECT {} FROM "{}"'.format(
+            ", ".join('"{}"'.format(column) for column in [key] + [field["db"] for field in fields]),
+            table,
+        )
+        filters = load_filters(mapping, columns)
+        if filters:
+            query += " WHERE " + " AND ".join("({})".format(f) for f in filters)
+        query += " ORDER BY " + ", ".join(load_order(mapping) + ['"{}"'.format(key)])
+        header = ["id"] + [field["sf"] for field in fields]
+        cursor = connection.execute(query)
+        batches = []
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            name = "batch_{:05d}.csv.gz".format(len(batches) + 1)
+            data = csv_batch(
+                header,
+                ([export_value(value, date) for value, date in zip(row, dates)] for row in rows),
+            )
+            with open(os.path.join(directory, name), "wb") as f:
+                f.write(data)
+            batches.append(
+                OrderedDict(
+                    [
+                        ("file", name),
+                        ("rows", len(rows)),
+                        ("sha256", hashlib.sha256(data).hexdigest()),
+                    ]
+                )
+            )
+    finally:
+        connection.close()
+    return OrderedDict(
+        [
+            ("directory", os.path.basename(directory)),
+            ("sf_object", mapping["sf_object"]),
+            ("rows", sum(batch["rows"] for batch in batches)),
+            ("batches", batches),
+        ]
+    )
+
+
+def export_value(value, date=False):
+    """Format a database value the way LoadData's _convert does, which sends
+       empty values for NULLs, zeros and empty strings"""
+    if not value:
+        return ""
+    if date and isinstance(value, (int, float)):
+        # The dataset databases store dates as epoch milliseconds
+        return datetime.utcfromtimestamp(value / 1000).isoformat()
+    return str(value)
+
+
+def csv_batch(header, rows):
+    """Render a gzipped CSV batch.  The gzip header's timestamp is left out
+       so that exporting the same rows again gives the same bytes, and zlib's
+       default level is used since level 9 is much slower for little gain."""
+    buffer = io.BytesIO()
+    with gzip.GzipFile(filename="", mode="wb", fileobj=buffer, mtime=0, compresslevel=6) as f:
+        text = io.TextIOWrapper(f, encoding="utf-8", newline="")
+        writer = csv.writer(text)
+        writer.writerow(header)
+        writer.writerows(rows)
+        text.flush()
+        text.detach()
+    return buffer.getvalue()
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
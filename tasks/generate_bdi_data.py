@@ -1,30 +1,99 @@
+import csv
+import hashlib
+import heapq
+import json
 import os
 import math
+import pickle
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from fractions import Fraction
+from itertools import chain
+from itertools import islice
+from itertools import repeat
+from operator import itemgetter
 from cumulusci.tasks.salesforce import BaseSalesforceApiTask
 from cumulusci.tasks.bulkdata import LoadData
+from cumulusci.core.exceptions import BulkDataException
+from cumulusci.core.exceptions import TaskOptionsError
 from cumulusci.core.utils import ordered_yaml_load
+from cumulusci.core.utils import process_bool_arg
 from cumulusci.utils import convert_to_snake_case, temporary_dir
 from cumulusci.core.config import TaskConfig
 from datetime import date
-from datetime import timedelta
+from datetime import datetime
 from sqlalchemy import create_engine
+from sqlalchemy import event
 from sqlalchemy import Column
 from sqlalchemy import MetaData
 from sqlalchemy import Integer
 from sqlalchemy import Table
 from sqlalchemy import Unicode
+from sqlalchemy import text
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.orm import create_session
 from sqlalchemy.sql.expression import func
 
+from tasks.load_csv_batches import LoadCSVBatches
+from tasks.load_csv_batches import step_directory
+
 
 START_DATE = date(2019, 1, 1)
+INSERT_MODES = ("orm", "bulk", "sql")
+STORAGE_MODES = ("file", "unsafe", "memory")
+OUTPUT_FORMATS = ("sqlite", "csv")
+# Options that only apply when generating into SQLite
+SQLITE_OPTIONS = (
+    "debug_db_path",
+    "pipeline",
+    "index_lookups",
+    "order_by_parent",
+    "contention_report",
+    "cache_dir",
+    "grow",
+)
+# Options that replace or rewrite the database, which growing it must not
+GROW_CONFLICTS = ("cache_dir", "pipeline", "order_by_parent")
+# The table in each generated database that records how it was generated
+GENERATION_STATE_TABLE = "generation_state"
+# The database is scratch space until generation finishes, so there is
+# nothing for a rollback journal or fsync to protect.
+UNSAFE_PRAGMAS = ("journal_mode=OFF", "synchronous=OFF")
+# In pipeline mode LoadData reads finished tables while later ones are
+# still being written, which needs write-ahead logging.
+PIPELINE_PRAGMAS = ("journal_mode=WAL",)
+# The generator and LoadData take turns to write in pipeline mode, and each
+# waits up to this many milliseconds for the other to commit.
+PIPELINE_BUSY_TIMEOUT = 60000
+# The number of records LoadData puts in each Bulk API batch
+LOAD_BATCH_SIZE = 10000
+# The number of rows of a mapping step with lookups that output_format csv
+# sorts in memory before spilling them to a temporary file to merge
+CSV_SORT_RUN_SIZE = 100000
 
 
 class BatchDataTask(BaseSalesforceApiTask):
     task_docs = """
     Use the `num_records` option to specify how many records to generate.
     Use the `mappings` option to specify a mapping file.
+
+    The wall time and rows/sec of each phase and table are summarized in the
+    log and, if `debug_db_path` is set, written to a .timings.json file next
+    to it.
+
+    With `grow`, an existing `debug_db_path` is extended from the number of
+    records it was generated with to `num_records`, and only the added
+    records are loaded.  Its `_sf_ids` tables record which records the org
+    already has, so delete it to start again with a new org.
     """
 
     task_options = {
@@ -34,349 +103,1858 @@ class BatchDataTask(BaseSalesforceApiTask):
         },
         "mapping_yaml": {"description": "A mapping YAML file to use", "required": True},
         "debug_db_path": {"description": "A path to put a copy of the sqlite database (for debugging)", "required": False},
+        "insert_mode": {
+            "description": "How generated rows are written: 'orm' (default) adds each record to the session, "
+            "'bulk' writes each table with batched executemany inserts, 'sql' has SQLite compute the rows "
+            "itself with INSERT ... SELECT statements.",
+            "required": False,
+        },
+        "chunk_size": {
+            "description": "If set, stream generated records and commit every chunk_size records "
+            "so that memory use stays flat regardless of num_records.",
+            "required": False,
+        },
+        "workers": {
+            "description": "Number of processes to generate records with. Each process writes its share "
+            "of the rows to its own SQLite shard with bulk inserts and the shards are merged at the end.",
+            "required": False,
+        },
+        "storage_mode": {
+            "description": "Where records are generated: 'file' (default) writes straight to the database file, "
+            "'unsafe' does the same with journaling and fsync turned off, 'memory' builds the database in "
+            "memory and copies it to the file with the SQLite backup API once it is complete.",
+            "required": False,
+        },
+        "pipeline": {
+            "description": "If True, generate records in a background thread and load each mapping step as soon "
+            "as its table and the tables it looks up have been generated, instead of after all of them.",
+            "required": False,
+        },
+        "index_lookups": {
+            "description": "If True, index the lookup key columns of each table once it is populated, so that "
+            "LoadData's lookup joins and ordering do not scan and sort the whole table.",
+            "required": False,
+        },
+        "order_by_parent": {
+            "description": "If True, renumber the rows of each table with lookups so that they are stored in the "
+            "order LoadData loads them, grouped by lookup parent, and update the lookups that point at them. "
+            "Tables whose primary key is a mapped Id column are left as they are.",
+            "required": False,
+        },
+        "contention_report": {
+            "description": "If True, log how many Bulk API batches touch each lookup parent and, if debug_db_path "
+            "is set, write the details to a .contention.json file next to it.",
+            "required": False,
+        },
+        "output_format": {
+            "description": "'sqlite' (default) generates into a SQLite database that LoadData loads from, 'csv' "
+            "streams records straight into Bulk API sized CSV batch files, one directory per mapping step, "
+            "and uploads those with LoadCSVBatches.",
+            "required": False,
+        },
+        "csv_dir": {
+            "description": "The directory to write CSV batches to when output_format is csv. "
+            "Defaults to a temporary directory.",
+            "required": False,
+        },
+        "cache_dir": {
+            "description": "If set, reuse a previously generated database from this directory when the mapping, "
+            "num_records and generator are unchanged, and store newly generated databases there.",
+            "required": False,
+        },
+        "cache_max_size": {
+            "description": "The total size in megabytes that cache_dir may grow to before the least recently "
+            "used databases are removed. Defaults to 1024.",
+            "required": False,
+        },
+        "grow": {
+            "description": "If True, add records to the database at debug_db_path, which an earlier run generated "
+            "with fewer records, instead of generating it from scratch, and load only the added records.",
+            "required": False,
+        },
     }
 
+    # Bump this whenever a change to generate_data changes its output, so
+    # that cached databases from the old version are not reused.
+    generator_version = 1
+
+    # Set while generating in pipeline mode
+    pipeline = None
+
+    # The num_records the database being grown was generated with
+    previous_num_records = 0
+
+    def _init_options(self, kwargs):
+        super(BatchDataTask, self)._init_options(kwargs)
+        self.options["insert_mode"] = self.options.get("insert_mode") or "orm"
+        if self.options["insert_mode"] not in INSERT_MODES:
+            raise TaskOptionsError(
+                "insert_mode must be one of: {}".format(", ".join(INSERT_MODES))
+            )
+        if self.options.get("chunk_size"):
+            self.options["chunk_size"] = int(self.options["chunk_size"])
+        self.options["workers"] = int(self.options.get("workers") or 1)
+        self.options["storage_mode"] = self.options.get("storage_mode") or "file"
+        if self.options["storage_mode"] not in STORAGE_MODES:
+            raise TaskOptionsError(
+                "storage_mode must be one of: {}".format(", ".join(STORAGE_MODES))
+            )
+        self.options["pipeline"] = process_bool_arg(self.options.get("pipeline", False))
+        if self.options["pipeline"] and self.options["storage_mode"] == "memory":
+            raise TaskOptionsError(
+                "The pipeline option needs the database on disk; use storage_mode file or unsafe."
+            )
+        self.options["index_lookups"] = process_bool_arg(
+            self.options.get("index_lookups", False)
+        )
+        self.options["order_by_parent"] = process_bool_arg(
+            self.options.get("order_by_parent", False)
+        )
+        if self.options["order_by_parent"] and self.options["pipeline"]:
+            raise TaskOptionsError(
+                "order_by_parent renumbers tables after they are generated, so it can't be used with pipeline."
+            )
+        self.options["contention_report"] = process_bool_arg(
+            self.options.get("contention_report", False)
+        )
+        if self.options.get("cache_dir"):
+            self.options["cache_dir"] = os.path.abspath(
+                os.path.expanduser(self.options["cache_dir"])
+            )
+        self.options["cache_max_size"] = int(self.options.get("cache_max_size") or 1024)
+        self.options["output_format"] = self.options.get("output_format") or "sqlite"
+        if self.options["output_format"] not in OUTPUT_FORMATS:
+            raise TaskOptionsError(
+                "output_format must be one of: {}".format(", ".join(OUTPUT_FORMATS))
+            )
+        if self.options["output_format"] == "csv":
+            sqlite_options = [name for name in SQLITE_OPTIONS if self.options.get(name)]
+            if sqlite_options or self.options["workers"] > 1:
+                raise TaskOptionsError(
+                    "These options can't be used with output_format csv: {}".format(
+                        ", ".join(sqlite_options + ["workers"] * (self.options["workers"] > 1))
+                    )
+                )
+        if self.options.get("csv_dir"):
+            self.options["csv_dir"] = os.path.abspath(self.options["csv_dir"])
+        self.options["grow"] = process_bool_arg(self.options.get("grow", False))
+        if self.options["grow"]:
+            if not self.options.get("debug_db_path"):
+                raise TaskOptionsError("The grow option needs a debug_db_path to grow.")
+            conflicts = [name for name in GROW_CONFLICTS if self.options.get(name)]
+            if conflicts or self.options["workers"] > 1:
+                raise TaskOptionsError(
+                    "These options can't be used with grow: {}".format(
+                        ", ".join(conflicts + ["workers"] * (self.options["workers"] > 1))
+                    )
+                )
+            if self.options["storage_mode"] != "file":
+                raise TaskOptionsError(
+                    "The grow option writes to an existing database, so it needs storage_mode file."
+                )
+
     def _run_task(self):
         mapping_file = os.path.abspath(self.options["mapping_yaml"])
         debug_db_path = self.options.get("debug_db_path")
+        self.timings = Timings()
+        if self.options["output_format"] == "csv":
+            with temporary_dir() as tempdir:
+                csv_dir = self.options.get("csv_dir") or os.path.join(tempdir, "csv")
+                self._generate_csv(csv_dir, mapping_file)
+                self._load_csv(csv_dir, mapping_file)
+            self.timings.log(self.logger)
+            return
         with temporary_dir() as tempdir:
             if(debug_db_path):
                 sqlite_path = debug_db_path
             else:
                 sqlite_path = os.path.join(tempdir, "generated_data.db")
             url = "sqlite:///" + sqlite_path
-            self._generate_data(url, mapping_file)
-            subtask_config = TaskConfig(
-                {"options": {"database_url": url, "mapping": mapping_file}}
-            )
-            subtask = LoadData(
-                project_config=self.project_config,
-                task_config=subtask_config,
-                org_config=self.org_config,
-                flow=self.flow,
-                name=self.name,
-                stepnum=self.stepnum,
-            )
+            if self.options.get("cache_dir"):
+                self._generate_cached_data(sqlite_path, mapping_file)
+            elif self.options["pipeline"]:
+                self._generate_and_load(url, mapping_file)
+            else:
+                self._generate_data(url, mapping_file)
+                self._load_data(url, mapping_file, resume=self.options["grow"])
+        self.timings.log(self.logger)
+        if debug_db_path:
+            timings_path = os.path.splitext(debug_db_path)[0] + ".timings.json"
+            self.timings.write(timings_path, num_records=int(self.options["num_records"]))
+            self.logger.info("Wrote timings to {}".format(timings_path))
+
+    def _load_data(self, db_url, mapping_file_path, pipeline=None, resume=False):
+        subtask_config = TaskConfig(
+            {"options": {"database_url": db_url, "mapping": mapping_file_path}}
+        )
+        subtask = PipelinedLoadData(
+            project_config=self.project_config,
+            task_config=subtask_config,
+            org_config=self.org_config,
+            flow=self.flow,
+            name=self.name,
+            stepnum=self.stepnum,
+        )
+        subtask.pipeline = pipeline
+        subtask.resume = resume
+        subtask.timings = self.timings
+        with self.timings.phase("load") as load:
+            subtask()
+            load["rows"] = subtask.rows_loaded
+
+    def _generate_csv(self, csv_dir, mapping_file_path):
+        """Write every generated record to CSV batch files"""
+        with open(mapping_file_path, "r") as f:
+            self.mappings = ordered_yaml_load(f)
+        with self.timings.phase("generation") as generation:
+            with CSVBatchWriter(csv_dir, self.mappings) as writer:
+                for table, fields in self.records():
+                    writer.write(table, fields)
+            generation["rows"] = writer.rows
+        self.logger.info("Wrote {} records to {}".format(writer.rows, csv_dir))
+
+    def _load_csv(self, csv_dir, mapping_file_path):
+        subtask_config = TaskConfig(
+            {"options": {"csv_dir": csv_dir, "mapping": mapping_file_path}}
+        )
+        subtask = LoadCSVBatches(
+            project_config=self.project_config,
+            task_config=subtask_config,
+            org_config=self.org_config,
+            flow=self.flow,
+            name=self.name,
+            stepnum=self.stepnum,
+        )
+        with self.timings.phase("load") as load:
             subtask()
+            load["rows"] = subtask.rows_loaded
 
     def _generate_data(self, db_url, mapping_file_path):
         """Generate all of the data"""
         with open(mapping_file_path, "r") as f:
             mappings = ordered_yaml_load(f)
 
-        session, base = init_db(db_url, mappings)
-        self.generate_data(session, base)
-        self.session.commit()
+        self.mappings = mappings
+        self.generation_state = OrderedDict(
+            [
+                ("generator", self.generator_key(mapping_file_path)),
+                ("num_records", str(int(self.options["num_records"]))),
+            ]
+        )
+        if self.options["grow"]:
+            self._init_growth(make_url(db_url).database)
+        storage_mode = self.options["storage_mode"]
+        self.pragmas = UNSAFE_PRAGMAS if storage_mode != "file" else ()
+        if self.options["pipeline"]:
+            self.pragmas = (
+                PIPELINE_PRAGMAS
+                + ("busy_timeout={}".format(PIPELINE_BUSY_TIMEOUT),)
+                + self.pragmas[1:]
+            )
+        if storage_mode == "memory":
+            session, base = init_db("sqlite://", mappings, self.pragmas, self.timings)
+        else:
+            session, base = init_db(
+                db_url,
+                mappings,
+                self.pragmas,
+                self.timings,
+                reuse_tables=bool(self.previous_num_records),
+            )
+        if self.pipeline:
+            self.pipeline.guard(session.bind)
+            self.pipeline.start(self._populate, session, base)
+            return
+        self._populate(session, base)
+        if storage_mode == "memory":
+            self.logger.info("Writing generated database to disk")
+            with self.timings.phase("backup"):
+                backup_database(session.bind, make_url(db_url).database)
+
+    def _populate(self, session, base):
+        try:
+            self.rows_generated = 0
+            with self.timings.phase("generation") as generation:
+                self.generate_data(session, base)
+                generation["rows"] = self.rows_generated
+            if self.options["order_by_parent"]:
+                with self.timings.phase("ordering"):
+                    self.order_by_parent()
+            if self.options["index_lookups"]:
+                with self.timings.phase("indexes"):
+                    self.index_lookups(base.metadata.tables)
+            # The generation state is only written once everything else
+            # has been, so that it never describes a database that failed
+            with self.timings.phase("commit"):
+                write_generation_state(session, self.generation_state)
+                self.session.commit()
+            if self.options["contention_report"]:
+                with self.timings.phase("contention report"):
+                    self.report_contention()
+        finally:
+            # Rolls back anything a failure left open, which in pipeline
+            # mode also frees the loader to write
+            session.close()
+
+    def _init_growth(self, sqlite_path):
+        """Check that the database at sqlite_path was generated the way this
+           run would generate it and note how many records it was generated
+           with, so that generate_data only adds the rest"""
+        state = read_generation_state(sqlite_path)
+        if state is None:
+            return
+        if state.get("generator") != self.generation_state["generator"]:
+            raise TaskOptionsError(
+                "{} was generated from a different mapping, recipe or generator version, "
+                "so it can't be grown.".format(sqlite_path)
+            )
+        num_records = int(self.options["num_records"])
+        self.previous_num_records = int(state["num_records"])
+        if self.previous_num_records > num_records:
+            raise TaskOptionsError(
+                "{} already has {} records, more than num_records.".format(
+                    sqlite_path, self.previous_num_records
+                )
+            )
+        self.logger.info(
+            "Growing {} from {} to {} records".format(
+                sqlite_path, self.previous_num_records, num_records
+            )
+        )
+
+    def _generate_and_load(self, db_url, mapping_file_path):
+        """Generate records in the background and load each mapping step
+           as soon as the tables it reads are complete"""
+        self.pipeline = GenerationPipeline()
+        try:
+            self._generate_data(db_url, mapping_file_path)
+            try:
+                self._load_data(db_url, mapping_file_path, self.pipeline)
+            except Exception:
+                self.pipeline.cancel()
+                raise
+            finally:
+                self.pipeline.join()
+        finally:
+            self.pipeline = None
+
+    def table_generated(self, table, rows):
+        """Called by generate_data once the rows it wrote to a table are
+           committed"""
+        self.rows_generated += rows
+        self.timings.table("generation", table, rows)
+        if self.pipeline:
+            if self.options["index_lookups"]:
+                self.index_lookups([table])
+            # End any transaction still open, so that the loader can write
+            # its id tables until the next table starts
+            self.session.commit()
+            self.pipeline.table_generated(table)
+
+    def index_lookups(self, tables):
+        """Index the lookup key columns of the mappings for tables"""
+        connection = self.session.connection()
+        for mapping in self.mappings.values():
+            if mapping["table"] in tables:
+                create_lookup_indexes(mapping, self.base.metadata, connection)
+
+    def order_by_parent(self):
+        """Renumber every table with lookups, parents first"""
+        connection = self.session.connection()
+        ordered = set()
+        for mapping in self.mappings.values():
+            if mapping["table"] in ordered:
+                continue
+            ordered.add(mapping["table"])
+            if not mapping.get("oid_as_pk"):
+                order_table_by_parent(mapping, self.mappings, connection)
+            elif load_order(mapping):
+                # Lookups to the table hold its text keys, which
+                # renumbering rows would not reorder
+                self.logger.warning(
+                    "Not ordering {} by parent: its primary key is the mapped Id "
+                    "column {}".format(mapping["table"], mapping["fields"]["Id"])
+                )
+
+    def report_contention(self):
+        connection = self.session.connection()
+        report = []
+        for name, mapping in self.mappings.items():
+            for lookup in lookup_contention(mapping, connection):
+                report.append(dict({"step": name}, **lookup))
+                self.logger.info(
+                    "{} {lookup}: {parents} {table} parents, {shared_parents} "
+                    "in more than one batch, at most {max_batches} batches "
+                    "per parent".format(name, **lookup)
+                )
+        debug_db_path = self.options.get("debug_db_path")
+        if debug_db_path:
+            report_path = os.path.splitext(debug_db_path)[0] + ".contention.json"
+            with open(report_path, "w") as f:
+                json.dump(report, f, indent=4)
+            self.logger.info("Wrote contention report to {}".format(report_path))
+
+    def _generate_cached_data(self, sqlite_path, mapping_file_path):
+        """Copy the database from the cache if it has already been
+           generated, otherwise generate it and add it to the cache"""
+        cache = DatabaseCache(
+            self.options["cache_dir"], self.options["cache_max_size"] * 1024 * 1024
+        )
+        key = self.cache_key(mapping_file_path)
+        url = "sqlite:///" + sqlite_path
+        with self.timings.phase("cache lookup"):
+            hit = cache.get(key, sqlite_path)
+        if hit:
+            self.logger.info("Using cached database {}".format(key))
+            if self.options["contention_report"]:
+                with self.timings.phase("contention report"):
+                    self._report_cached_contention(url, mapping_file_path)
+            self._load_data(url, mapping_file_path)
+            return
+        if self.options["pipeline"]:
+            self._generate_and_load(url, mapping_file_path)
+            with self.timings.phase("cache store"):
+                cache.put(key, sqlite_path, exclude_suffix="_sf_ids")
+        else:
+            self._generate_data(url, mapping_file_path)
+            with self.timings.phase("cache store"):
+                cache.put(key, sqlite_path)
+            self._load_data(url, mapping_file_path)
+        self.logger.info("Cached generated database as {}".format(key))
+
+    def _report_cached_contention(self, db_url, mapping_file_path):
+        """Report contention for a database copied from the cache, which
+           was not generated by this run"""
+        with open(mapping_file_path, "r") as f:
+            self.mappings = ordered_yaml_load(f)
+        engine = create_engine(db_url)
+        self.session = create_session(bind=engine, autocommit=False)
+        try:
+            self.report_contention()
+        finally:
+            self.session.close()
+            engine.dispose()
+
+    def cache_key(self, mapping_file_path):
+        """Hash everything that determines the generated database"""
+        return self.generator_key(
+            mapping_file_path,
+            str(int(self.options["num_records"])),
+            "index_lookups={}".format(self.options["index_lookups"]),
+            "order_by_parent={}".format(self.options["order_by_parent"]),
+        )
+
+    def generator_key(self, mapping_file_path, *extra):
+        """Hash the generator and the files it reads, along with any extra
+           strings"""
+        cls = type(self)
+        digest = hashlib.sha256()
+        for part in (
+            "{}.{}".format(cls.__module__, cls.__name__),
+            str(self.generator_version),
+        ) + extra:
+            digest.update(part.encode("utf-8") + b"\0")
+        for path in [mapping_file_path] + self.cache_key_files():
+            with open(path, "rb") as f:
+                digest.update(f.read())
+        return digest.hexdigest()
+
+    def cache_key_files(self):
+        """Files other than the mapping that generate_data reads"""
+        return []
 
     def generate_data(self, session, base):
+        """Write the records for num_records, or with the grow option only
+           those that previous_num_records did not already write"""
         raise NotImplementedError("generate_data method")
 
+    def records(self):
+        """Yield (table name, fields) for every record, parent tables first.
+           Needed for output_format csv."""
+        raise NotImplementedError("records method")
 
-class Adder:
-    def __init__(self, x=0):
-        self.x = x
 
-    def __call__(self, value):
-        self.x += value
-        return int(self.x)
+class DatabaseCache:
+    """A directory of generated SQLite databases named by cache key.  Once
+       the directory grows past max_size bytes the least recently used
+       databases are removed."""
 
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
 
-class GenerateBDIData(BatchDataTask):
-    def generate_data(self, session, base):
-        self.session = session
-        self.base = base
-        num_records = int(self.options["num_records"])
-        batch_size = math.floor(num_records / 10)
-        self.make_all_records(batch_size)
-        self.generate_bdi_denormalized_table(num_records)
-        self.session.commit()
+    def path(self, key):
+        return os.path.join(self.directory, key + ".db")
 
-    def make_opportunity(self, amount, date, paid, payment_amount, **kw):
-        """Make a specific opportunity and matching payment records"""
-        opp = self.Opportunity(
-            amount=amount, stage_name="Prospecting", close_date=date, **kw
+    def get(self, key, target_path):
+        """Copy the database for key to target_path if it is cached"""
+        path = self.path(key)
+        if not os.path.exists(path):
+            return False
+        shutil.copyfile(path, target_path)
+        os.utime(path)
+        return True
+
+    def put(self, key, source_path, exclude_suffix=None):
+        """Add the database at source_path, leaving out any tables whose
+           names end with exclude_suffix"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key)
+        # Runs sharing the cache each copy to their own file, so that only
+        # complete databases are ever renamed into place.
+        fd, partial_path = tempfile.mkstemp(
+            prefix=key + ".", suffix=".partial", dir=self.directory
         )
-        self.session.add(opp)
-        self.session.flush()
-        if payment_amount:
-            payment = self.Payment(
-                npe01__opportunity__c=opp.id,
-                amount=payment_amount,
-                payment_date=date,
-                paid=paid,
-                scheduled_date=date
+        os.close(fd)
+        try:
+            self.copy(source_path, partial_path, exclude_suffix)
+            os.replace(partial_path, path)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+        self.evict(keep=path)
+
+    def copy(self, source_path, target_path, exclude_suffix=None):
+        # Unlike a file copy, the backup API includes rows that are still
+        # in a write-ahead log.
+        source = sqlite3.connect(source_path)
+        target = sqlite3.connect(target_path)
+        try:
+            source.backup(target)
+            if exclude_suffix:
+                tables = [
+                    name
+                    for (name,) in target.execute(
+                        "SELECT name FROM sqlite_master WHERE type = 'table'"
+                    )
+                    if name.endswith(exclude_suffix)
+                ]
+                for table in tables:
+                    target.execute('DROP TABLE "{}"'.format(table))
+                target.commit()
+        finally:
+            target.close()
+            source.close()
+
+    def evict(self, keep=None):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".db"):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if path != keep:
+                os.remove(path)
+                total -= size
+
+
+class GenerationPipeline:
+    """Runs generation in a background thread and tells the loader which
+       tables are complete.  SQLite allows one writer at a time, so the
+       generator holds `lock` for each of its transactions and the loader
+       takes it to write."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.generated = defaultdict(threading.Event)
+        self.finished = threading.Event()
+        self.cancelled = False
+        self.error = None
+        self.thread = None
+
+    def guard(self, engine):
+        """Hold the lock for the length of every transaction on engine"""
+
+        @event.listens_for(engine, "begin")
+        def begin(connection):
+            self.lock.acquire()
+            connection.info["pipeline_lock"] = True
+
+        @event.listens_for(engine, "commit")
+        @event.listens_for(engine, "rollback")
+        def end(connection):
+            if connection.info.pop("pipeline_lock", False):
+                self.lock.release()
+
+    def start(self, target, *args):
+        self.thread = threading.Thread(target=self.run, args=(target,) + args)
+        self.thread.start()
+
+    def run(self, target, *args):
+        try:
+            target(*args)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.finished.set()
+
+    def table_generated(self, table):
+        if self.cancelled:
+            raise BulkDataException("Data generation cancelled")
+        self.generated[table].set()
+
+    def wait_for(self, tables):
+        for table in tables:
+            event = self.generated[table]
+            while not event.wait(1):
+                if self.finished.is_set():
+                    break
+            if self.error:
+                raise BulkDataException(
+                    "Data generation failed: {}".format(self.error)
+                ) from self.error
+
+    def cancel(self):
+        self.cancelled = True
+
+    def join(self):
+        self.thread.join()
+        if self.error and not self.cancelled:
+            raise self.error
+
+
+class PipelinedLoadData(LoadData):
+    """LoadData that records the time and rows of each step and, when given
+       a GenerationPipeline, waits before each step until its table and the
+       tables it looks up are generated.  With resume set, it keeps the
+       database's id tables and only loads rows after the last one in them."""
+
+    pipeline = None
+    resume = False
+    timings = None
+    rows_loaded = 0
+
+    def _init_db(self):
+        super(PipelinedLoadData, self)._init_db()
+        if self.pipeline:
+            set_pragmas(self.engine, ["busy_timeout={}".format(PIPELINE_BUSY_TIMEOUT)])
+        # Note where each id table ends before any step adds to it, so that
+        # after-steps update the same rows their insert step loaded
+        self.loaded_ids = {}
+        if self.resume:
+            for table in self.models:
+                id_table = "{}_sf_ids".format(table)
+                if id_table in self.metadata.tables:
+                    self.loaded_ids[table] = self.session.execute(
+                        'SELECT MAX(CAST(id AS INTEGER)) FROM "{}"'.format(id_table)
+                    ).scalar()
+
+    def _query_db(self, mapping):
+        query = super(PipelinedLoadData, self)._query_db(mapping)
+        loaded = self.loaded_ids.get(mapping["table"])
+        if loaded is not None:
+            model = self.models[mapping["table"]]
+            query = query.filter(model.__table__.primary_key.columns.values()[0] > loaded)
+        return query
+
+    def _reset_id_table(self, mapping):
+        if not self.resume:
+            return super(PipelinedLoadData, self)._reset_id_table(mapping)
+        id_table_name = "{}_sf_ids".format(mapping["table"])
+        if id_table_name not in self.metadata.tables:
+            Table(
+                id_table_name,
+                self.metadata,
+                Column("id", Unicode(255), primary_key=True),
+                Column("sf_id", Unicode(18)),
+            ).create()
+        return id_table_name
+
+    def _load_mapping(self, mapping):
+        if self.pipeline:
+            tables = [mapping["table"]] + [
+                lookup["table"] for lookup in mapping.get("lookups", {}).values()
+            ]
+            self.pipeline.wait_for(tables)
+        start = time.time()
+        mapping["rows_loaded"] = 0
+        result = super(PipelinedLoadData, self)._load_mapping(mapping)
+        self._step_loaded(mapping, time.time() - start)
+        return result
+
+    def _step_loaded(self, mapping, seconds):
+        if self.timings:
+            self.timings.table(
+                "load", mapping["sf_object"], mapping["rows_loaded"], seconds
             )
-            self.session.add(payment)
-
-    def make_records(
-        self, model, name, key_field, start, end, amount, paid, payment_amount
-    ):
-        """Make a batch of records according to a specification"""
-        date = START_DATE
-        for i in range(start, end):
-            parent = model(name=name + " " + str(i))
-            if model is self.Account:
-                parent.record_type = "Organization"
-            self.session.add(parent)
-            self.session.flush()
-            kw = {key_field: parent.id, "name": "%s %d Donation" % (name, i)}
-            self.make_opportunity(amount, date, paid, payment_amount, **kw)
-            date = date + timedelta(days=1)
-
-    def make_all_records(self, batch_size):
-        """Make all of the records"""
-        base = self.base
-
-        Account = self.Account = base.classes.accounts
-        Contact = self.Contact = base.classes.contacts
-        self.Opportunity = base.classes.opportunities
-        self.Payment = base.classes.payments
-        account_adder = Adder(1)
-
-        self.make_records(
-            Account,
-            "Account",
-            "account_id",
-            account_adder(0),
-            account_adder(batch_size),
-            amount=100,
-            paid=False,
-            payment_amount=100,
-        )
-        self.make_records(
-            Account,
-            "Account",
-            "account_id",
-            account_adder(0),
-            account_adder(batch_size),
-            amount=200,
-            paid=False,
-            payment_amount=200,
-        )
-        self.make_records(
-            Account,
-            "Account",
-            "account_id",
-            account_adder(0),
-            account_adder(batch_size),
-            amount=300,
-            paid=False,
-            payment_amount=50,
-        )
-        self.make_records(
-            Account,
-            "Account",
-            "account_id",
-            account_adder(0),
-            account_adder(batch_size),
-            amount=400,
-            paid=True,
-            payment_amount=50,
-        )
-        self.make_records(
-            Account,
-            "Account",
-            "account_id",
-            account_adder(0),
-            account_adder(batch_size),
-            amount=500,
-            paid=False,
-            payment_amount=None,
+        self.rows_loaded += mapping["rows_loaded"]
+
+    def _process_job_results(self, mapping, job_id, local_ids_for_batch):
+        mapping["rows_loaded"] = sum(len(ids) for ids in local_ids_for_batch.values())
+        if self.pipeline:
+            # Wait for the generator to commit before writing the id table
+            with self.pipeline.lock:
+                super(PipelinedLoadData, self)._process_job_results(
+                    mapping, job_id, local_ids_for_batch
+                )
+        else:
+            super(PipelinedLoadData, self)._process_job_results(
+                mapping, job_id, local_ids_for_batch
+            )
+
+
+class Timings:
+    """Wall time and row counts for each phase of a BatchDataTask run and
+       for each table within a phase"""
+
+    def __init__(self):
+        self.phases = []
+        self.tables = []
+        self.marks = {}
+
+    @contextmanager
+    def phase(self, name):
+        """Time the body of the with statement, which can set the rows
+           written in the yielded dict"""
+        entry = {"name": name, "seconds": None, "rows": None}
+        start = self.marks[name] = time.time()
+        try:
+            yield entry
+        finally:
+            entry["seconds"] = time.time() - start
+            self.phases.append(entry)
+
+    def table(self, phase, name, rows, seconds=None):
+        """Record a table of a phase.  Without seconds, the time since the
+           phase started or its previous table finished is used."""
+        now = time.time()
+        if seconds is None:
+            seconds = now - self.marks.get(phase, now)
+            self.marks[phase] = now
+        self.tables.append(
+            {"phase": phase, "name": name, "seconds": seconds, "rows": rows}
         )
 
-        contacts_adder = Adder(1)
-        self.make_records(
-            Contact,
-            "Contact",
-            "primary_contact__c",
-            contacts_adder(0),
-            contacts_adder(batch_size),
-            amount=600,
-            paid=False,
-            payment_amount=600,
+    def as_dict(self, **extra):
+        def with_rate(entry):
+            rate = None
+            if entry["rows"] is not None and entry["seconds"]:
+                rate = entry["rows"] / entry["seconds"]
+            return dict(entry, rows_per_second=rate)
+
+        return dict(
+            extra,
+            phases=[with_rate(entry) for entry in self.phases],
+            tables=[with_rate(entry) for entry in self.tables],
         )
-        self.make_records(
-            Contact,
-            "Contact",
-            "primary_contact__c",
-            contacts_adder(0),
-            contacts_adder(batch_size),
-            amount=700,
-            paid=False,
-            payment_amount=700,
+
+    def write(self, path, **extra):
+        with open(path, "w") as f:
+            json.dump(self.as_dict(**extra), f, indent=4)
+
+    def log(self, logger):
+        timings = self.as_dict()
+        logger.info("Timings:")
+        for phase in timings["phases"]:
+            logger.info("  " + self.describe(phase))
+            for table in timings["tables"]:
+                if table["phase"] == phase["name"]:
+                    logger.info("    " + self.describe(table))
+
+    @staticmethod
+    def describe(entry):
+        text = "{}: {:.2f}s".format(entry["name"], entry["seconds"])
+        if entry["rows"] is not None:
+            text += ", {} rows".format(entry["rows"])
+        if entry["rows_per_second"] is not None:
+            text += ", {:.0f} rows/s".format(entry["rows_per_second"])
+        return text
+
+
+def csv_value(value):
+    """Format a value the way it would come back out of SQLite"""
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return str(int(value))
+    return str(value)
+
+
+class CSVBatchWriter:
+    """Writes generated records straight to CSV batch files, one directory
+       per mapping step.  The first column of each file holds the record's
+       local key and the rest are headed by the Salesforce field names from
+       fields_for_mapping, with lookups still holding local keys."""
+
+    def __init__(self, directory, mappings, batch_size=LOAD_BATCH_SIZE):
+        self.steps = defaultdict(list)
+        self.rows = 0
+        for index, (name, mapping) in enumerate(mappings.items()):
+            if mapping.get("filters"):
+                raise TaskOptionsError(
+                    "Mapping step {} has filters, which need output_format sqlite".format(name)
+                )
+            self.steps[mapping["table"]].append(
+                CSVStepWriter(
+                    os.path.join(directory, step_directory(index, name)),
+                    mapping,
+                    batch_size,
+                )
+            )
+
+    def write(self, table, fields):
+        for step in self.steps[table]:
+            step.write(fields)
+        self.rows += 1
+
+    def close(self):
+        for steps in self.steps.values():
+            for step in steps:
+                step.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CSVStepWriter:
+    """Writes the CSV batch files of one mapping step.  Like LoadData, rows
+       are ordered by the step's lookup columns so that children of the same
+       parent share batches; they are sorted in runs of run_size rows that
+       are merged when the step is closed."""
+
+    def __init__(self, directory, mapping, batch_size, run_size=CSV_SORT_RUN_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.batch_size = batch_size
+        self.run_size = run_size
+        self.record_type = mapping.get("record_type")
+        self.key = mapping.get("fields", {}).get("Id") or "id"
+        fields = [
+            field
+            for field in fields_for_mapping(mapping)
+            if field["sf"] != "Id" or mapping.get("action") == "update"
+        ]
+        self.header = ["id"] + [field["sf"] for field in fields]
+        self.columns = [field["db"] for field in fields]
+        self.order = [
+            get_lookup_key_field(lookup, sf_field)
+            for sf_field, lookup in load_lookups(mapping).items()
+        ]
+        self.pending = []
+        self.runs = []
+        self.file = None
+        self.batches = 0
+        self.count = 0
+
+    def write(self, fields):
+        if self.record_type and fields.get("record_type") != self.record_type:
+            return
+        row = [fields[self.key]] + [
+            csv_value(fields.get(column)) for column in self.columns
+        ]
+        if not self.order:
+            self.write_row(row)
+            return
+        # Lookup columns are text in SQLite, which sorts NULL first and
+        # then compares the text of each value
+        key = tuple(
+            (fields.get(column) is not None, csv_value(fields.get(column)))
+            for column in self.order
         )
-        self.make_records(
-            Contact,
-            "Contact",
-            "primary_contact__c",
-            contacts_adder(0),
-            contacts_adder(batch_size),
-            amount=800,
-            paid=False,
-            payment_amount=50,
+        self.pending.append((key, row))
+        if len(self.pending) == self.run_size:
+            self.spill()
+
+    def spill(self):
+        """Write the pending rows to a temporary file, sorted"""
+        run = tempfile.TemporaryFile()
+        for entry in sorted(self.pending, key=itemgetter(0)):
+            pickle.dump(entry, run, pickle.HIGHEST_PROTOCOL)
+        run.seek(0)
+        self.runs.append(run)
+        self.pending = []
+
+    def read_run(self, run):
+        while True:
+            try:
+                yield pickle.load(run)
+            except EOFError:
+                return
+
+    def write_row(self, row):
+        if self.file is None or self.count == self.batch_size:
+            self.start_batch()
+        self.writer.writerow(row)
+        self.count += 1
+
+    def start_batch(self):
+        self.close_batch()
+        self.batches += 1
+        path = os.path.join(self.directory, "batch_{:05d}.csv".format(self.batches))
+        self.file = open(path, "w", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.header)
+        self.count = 0
+
+    def close_batch(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        try:
+            pending = sorted(self.pending, key=itemgetter(0))
+            # Both sorts are stable, so rows with equal lookups stay in the
+            # order they were generated
+            for key, row in heapq.merge(
+                *[self.read_run(run) for run in self.runs] + [pending],
+                key=itemgetter(0)
+            ):
+                self.write_row(row)
+        finally:
+            for run in self.runs:
+                run.close()
+            self.pending = []
+            self.runs = []
+            self.close_batch()
+
+
+def attached_table(connection, schema, table):
+    """The columns of a table in an attached database, mapped to their
+       declared types, and the name of its primary key column"""
+    columns = OrderedDict()
+    key = None
+    for row in connection.execute('PRAGMA {}.table_info("{}")'.format(schema, table)):
+        columns[row[1]] = row[2]
+        if row[5] and key is None:
+            key = row[1]
+    if not columns or key is None:
+        path = next(
+            row[2] for row in connection.execute("PRAGMA database_list") if row[1] == schema
         )
-        self.make_records(
-            Contact,
-            "Contact",
-            "primary_contact__c",
-            contacts_adder(0),
-            contacts_adder(batch_size),
-            amount=900,
-            paid=True,
-            payment_amount=50,
+        raise TaskOptionsError(
+            "{} has no {} table with a primary key".format(path, table)
         )
-        self.make_records(
-            Contact,
-            "Contact",
-            "primary_contact__c",
-            contacts_adder(0),
-            contacts_adder(batch_size),
-            amount=1000,
-            paid=False,
-            payment_amount=None,
+    return columns, key
+
+
+def copy_ddl(connection, schema, tables, kind):
+    """Run the CREATE statements of the given kind, 'table' or 'index', for
+       the given tables of an attached database in the main database"""
+    for (sql,) in connection.execute(
+        "SELECT sql FROM {}.sqlite_master WHERE type = ? AND sql IS NOT NULL "
+        "AND tbl_name IN ({})".format(schema, ", ".join("?" for _ in tables)),
+        [kind] + list(tables),
+    ).fetchall():
+        connection.execute(sql)
+
+
+def column_affinity(declared_type):
+    """SQLite's type affinity for a column's declared type"""
+    declared = (declared_type or "").upper()
+    if "INT" in declared:
+        return "INTEGER"
+    if "CHAR" in declared or "CLOB" in declared or "TEXT" in declared:
+        return "TEXT"
+    if not declared or "BLOB" in declared:
+        return "BLOB"
+    if "REAL" in declared or "FLOA" in declared or "DOUB" in declared:
+        return "REAL"
+    return "NUMERIC"
+
+
+def chunks(iterable, size):
+    """Split an iterable into lists of at most size items"""
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+class BulkInserter:
+    """Buffers rows per table and writes them with executemany inserts
+       through SQLAlchemy Core instead of one ORM round trip per row."""
+
+    def __init__(self, session, batch_size=10000):
+        self.session = session
+        self.batch_size = batch_size
+        self.buffers = {}
+
+    def insert(self, table, values):
+        # executemany needs every row in a batch to bind the same columns
+        key = (table, tuple(values))
+        rows = self.buffers.setdefault(key, [])
+        rows.append(values)
+        if len(rows) >= self.batch_size:
+            self.flush_buffer(key)
+
+    def flush_buffer(self, key):
+        rows = self.buffers.pop(key, None)
+        if rows:
+            table = key[0]
+            self.session.execute(table.insert(), rows)
+
+    def flush(self):
+        for key in list(self.buffers):
+            self.flush_buffer(key)
+
+
+class Template:
+    """A string field value compiled to a positional format string, so that
+       a whole column can be formatted without building a dict per row."""
+
+    pattern = re.compile(r"%\(([^)]*)\)")
+    # Conversions that SQLite's printf() formats the same way as Python
+    sql_pattern = re.compile(r"%\(([^)]*)\)([-+ 0]*[0-9]*(?:\.[0-9]+)?[dixXoeEfgGs])")
+
+    def __init__(self, value):
+        self.value = value
+        self.names = self.pattern.findall(value)
+        self.format = self.pattern.sub("%", value)
+        unescaped = value.replace("%%", "")
+        if len(self.sql_pattern.findall(unescaped)) != len(
+            self.pattern.findall(unescaped)
+        ):
+            raise TaskOptionsError(
+                "Unsupported format in recipe value {!r}: use conversions "
+                "d, i, x, X, o, e, E, f, g, G or s with optional -+ 0 flags, "
+                "width and precision".format(value)
+            )
+
+    def column(self, context, count):
+        if not self.names:
+            return repeat(self.format % (), count)
+        if len(self.names) == 1:
+            return [self.format % value for value in context[self.names[0]]]
+        columns = [context[name] for name in self.names]
+        return [self.format % values for values in zip(*columns)]
+
+    def sql(self, context, params, prefix):
+        """Return a SQL expression that concatenates the template's literal
+           text, bound as params, with the SQL expressions in context"""
+        parts = self.sql_pattern.split(self.value.replace("%%", "%"))
+        terms = []
+        for index in range(0, len(parts), 3):
+            if parts[index]:
+                name = "{}_{}".format(prefix, index)
+                params[name] = parts[index]
+                terms.append(":" + name)
+            if index + 1 < len(parts):
+                expression, spec = context[parts[index + 1]], parts[index + 2]
+                if spec not in ("d", "s"):
+                    expression = "printf('%{}', {})".format(spec, expression)
+                terms.append(expression)
+        return " || ".join(terms) or "''"
+
+
+def compile_fields(fields):
+    """Compile the string values of a table's fields into Templates"""
+    return {
+        name: Template(value) if isinstance(value, str) else value
+        for name, value in fields.items()
+    }
+
+
+class Segment:
+    """A run of generated rows.  Row k of a segment writes one record to
+       each of its tables.  Template field values are formatted with the
+       row's counter value `i`, its `date` and the ids of the records
+       written for the row, keyed by table name.  Rows before start are
+       already in the database being grown."""
+
+    def __init__(self, count, tables, counter_start=0, start_date=START_DATE, start=0):
+        self.count = count
+        self.tables = [(table, compile_fields(fields)) for table, fields in tables]
+        self.counter_start = counter_start
+        self.start_date = start_date
+        self.start = start
+        self.id_offsets = {}
+
+    def records(self, start, end, block_size=10000, tables=None):
+        """Yield (table name, fields) for rows start <= k < end, building
+           each column for a block of rows at a time.  If tables is given
+           only records for those tables are yielded."""
+        for block_start in range(start, end, block_size):
+            block_end = min(end, block_start + block_size)
+            count = block_end - block_start
+            first_day = self.start_date.toordinal() + block_start
+            context = {
+                "i": range(
+                    self.counter_start + block_start + 1,
+                    self.counter_start + block_end + 1,
+                ),
+                "date": [
+                    date.fromordinal(day).isoformat()
+                    for day in range(first_day, first_day + count)
+                ],
+            }
+            for table, _ in self.tables:
+                offset = self.id_offsets[table]
+                context[table] = range(offset + block_start + 1, offset + block_end + 1)
+            for table, fields in self.tables:
+                if tables is not None and table not in tables:
+                    continue
+                names = ["id"] + list(fields)
+                columns = [context[table]] + [
+                    value.column(context, count)
+                    if isinstance(value, Template)
+                    else repeat(value, count)
+                    for value in fields.values()
+                ]
+                for values in zip(*columns):
+                    yield table, dict(zip(names, values))
+
+    def insert(self, session, table, start, end, chunk_size=None):
+        """Write the records for table of rows start <= k < end with
+           INSERT ... SELECT statements over a recursive row counter, so
+           that SQLite formats every value itself"""
+        fields = dict(self.tables)[table]
+        params = {"start_date": self.start_date.isoformat()}
+        context = {
+            "i": "({} + n + 1)".format(int(self.counter_start)),
+            "date": "date(:start_date, '+' || n || ' days')",
+        }
+        for name, _ in self.tables:
+            context[name] = "({} + n + 1)".format(int(self.id_offsets[name]))
+        columns = [context[table]]
+        for index, value in enumerate(fields.values()):
+            name = "f{}".format(index)
+            if isinstance(value, Template):
+                columns.append(value.sql(context, params, name))
+            else:
+                params[name] = value
+                columns.append(":" + name)
+        statement = text(
+            "WITH RECURSIVE k(n) AS "
+            "(SELECT :start UNION ALL SELECT n + 1 FROM k WHERE n + 1 < :end) "
+            'INSERT INTO "{}" ({}) SELECT {} FROM k'.format(
+                table,
+                ", ".join('"{}"'.format(column) for column in ["id"] + list(fields)),
+                ", ".join(columns),
+            )
         )
+        step = chunk_size or max(end - start, 1)
+        for chunk_start in range(start, end, step):
+            session.execute(
+                statement,
+                dict(params, start=chunk_start, end=min(end, chunk_start + step)),
+            )
+            session.commit()
 
-    def generate_bdi_denormalized_table(self, num_records):
-        """BDI has a denormalized import table called npsp__DataImport__c.
-           Generate that table using a mix of matching and umatching data.
-           """
-        self.generate_matching_records(num_records)
-
-    def generate_matching_records(self, num_records):
-        """Generate records that match what's already "in" the org by
-           copying the records from the tables that will be populated in the
-           org. """
-        batch_size = math.floor(num_records / 10)
-
-        def cleanup_value(value, context):
-            if type(value)==str:
-                return value % context
-            elif type(value)==bool:
-                return str(value).upper()
+
+class Recipe:
+    """A generation recipe: groups of segments read from a YAML file, such
+       as datasets/bdi_benchmark/recipe.yml"""
+
+    def __init__(self, path):
+        with open(path, "r") as f:
+            recipe = ordered_yaml_load(f)
+        self.start_date = recipe.get("start_date", START_DATE)
+        self.groups = recipe["groups"]
+
+    def segments(self, num_records, previous_num_records=0):
+        """Size every segment for num_records and start its counter where
+           the previous segment with the same counter in its group ended.
+
+           When growing a database generated for previous_num_records, each
+           segment starts at the row it ended at then, with its dates
+           carrying on from there, and the counter values of the added rows
+           start after every value the group used then."""
+        for group in self.groups:
+            specs = []
+            counters = defaultdict(int)
+            for spec in group["segments"]:
+                tables = list(spec["tables"].items())
+                proportion = Fraction(str(spec.get("proportion", group.get("proportion"))))
+                counter = spec.get("counter", tables[0][0])
+                start = math.floor(previous_num_records * proportion)
+                specs.append((tables, proportion, counter, start))
+                counters[counter] += start
+            for tables, proportion, counter, start in specs:
+                count = math.floor(num_records * proportion)
+                yield Segment(
+                    count, tables, counters[counter] - start, self.start_date, start
+                )
+                counters[counter] += count - start
+
+
+def plan_segments(segments, high_water=None):
+    """Assign every segment the primary keys its records start after, so
+       that any range of rows can be generated without the ones before it.
+       When growing a database, new records are numbered from the highest
+       id already in each table, given in high_water."""
+    totals = defaultdict(int, high_water or {})
+    segments = list(segments)
+    for segment in segments:
+        for table, _ in segment.tables:
+            segment.id_offsets[table] = totals[table] - segment.start
+            totals[table] += segment.count - segment.start
+    return segments
+
+
+def shard_range(count, shard, shards):
+    """The slice of range(count) that a shard is responsible for"""
+    return count * shard // shards, count * (shard + 1) // shards
+
+
+def max_id(session, table):
+    return session.execute('SELECT MAX(id) FROM "{}"'.format(table)).scalar() or 0
+
+
+def write_records(session, base, records, bulk=False, chunk_size=None):
+    """Write (table name, fields) records to the database, committing
+       every chunk_size records if it is set"""
+    inserter = BulkInserter(session) if bulk else None
+    for chunk in chunks(records, chunk_size) if chunk_size else [records]:
+        for table, fields in chunk:
+            if inserter:
+                inserter.insert(base.metadata.tables[table], fields)
             else:
-                return value
-
-        def make_records_import_table(adder, **kwargs):
-            autoincrement_date = START_DATE
-            for i in range(adder(0), adder(batch_size)):
-                replaceables = {'i': i}
-                fields = {key: cleanup_value(value, replaceables) for key, value in kwargs.items()}
-                fields['npsp__Donation_Date__c'] = autoincrement_date
-                fields.setdefault('npsp__Do_Not_Automatically_Create_Payment__c', "FALSE")
-                record = self.base.classes.npsp__DataImport__c(**fields)
-                autoincrement_date = autoincrement_date + timedelta(days=1)
-                self.session.add(record)
-
-        account_adder = Adder(1)
-
-        make_records_import_table(account_adder,
-            npsp__Account1_Name__c = "Account %(i)d",
-            npsp__Donation_Amount__c = 100,
-            npsp__Donation_Donor__c = "Account1")
-
-        make_records_import_table(account_adder,
-            npsp__Account1_Name__c = "Account %(i)d",
-            npsp__Donation_Amount__c = 200,
-            npsp__Donation_Donor__c = "Account1",
-            npsp__Qualified_Date__c = '2020-01-01')
-
-        make_records_import_table(account_adder,
-            npsp__Account1_Name__c = "Account %(i)d",
-            npsp__Donation_Amount__c = 50,
-            npsp__Donation_Donor__c = "Account1")
-
-        make_records_import_table(account_adder,
-            npsp__Account1_Name__c = "Account %(i)d",
-            npsp__Donation_Amount__c = 400,
-            npsp__Donation_Donor__c = "Account1")
-
-        make_records_import_table(account_adder,
-            npsp__Account1_Name__c = "Account %(i)d",
-            npsp__Donation_Amount__c = 500,
-            npsp__Donation_Donor__c = "Account1")
-
-        contact_adder = Adder(1)
-
-        make_records_import_table(contact_adder,
-            npsp__Contact1_Lastname__c = "Contact %(i)d",
-            npsp__Donation_Amount__c = 600,
-            npsp__Donation_Donor__c = "Contact1")
-
-        make_records_import_table(contact_adder,
-            npsp__Contact1_Lastname__c = "Contact %(i)d",
-            npsp__Donation_Amount__c = 700,
-            npsp__Donation_Donor__c = "Contact1",
-            npsp__Qualified_Date__c = '2020-01-01')
-
-        make_records_import_table(contact_adder,
-            npsp__Contact1_Lastname__c = "Contact %(i)d",
-            npsp__Donation_Amount__c = 50,
-            npsp__Donation_Donor__c = "Contact1")
-
-        make_records_import_table(contact_adder,
-            npsp__Contact1_Lastname__c = "Contact %(i)d",
-            npsp__Donation_Amount__c = 900,
-            npsp__Donation_Donor__c = "Contact1")
-
-        make_records_import_table(contact_adder,
-            npsp__Contact1_Lastname__c = "Contact %(i)d",
-            npsp__Donation_Amount__c = 1000,
-            npsp__Donation_Donor__c = "Contact1")
-
-        batch_size = math.floor(num_records / 4)
-        account_adder = Adder(1)
-
-        make_records_import_table(account_adder,
-            npsp__Account1_Name__c = "Account%(i)d",
-            npsp__Donation_Amount__c = 100,
-            npsp__Donation_Donor__c = "Account1",
-            npsp__Do_Not_Automatically_Create_Payment__c = False
+                session.add(base.classes[table](**fields))
+        if inserter:
+            inserter.flush()
+        session.commit()
+        session.expunge_all()
+
+
+def generate_shard(
+    db_url,
+    mappings,
+    segments,
+    shard,
+    shards,
+    chunk_size=None,
+    pragmas=(),
+    insert_mode="bulk",
+):
+    """Generate one worker's share of every segment into its own database"""
+    session, base = init_db(db_url, mappings, pragmas)
+    if insert_mode == "sql":
+        for segment in segments:
+            for table, _ in segment.tables:
+                start, end = shard_range(segment.count, shard, shards)
+                segment.insert(session, table, start, end, chunk_size)
+    else:
+        records = chain.from_iterable(
+            segment.records(*shard_range(segment.count, shard, shards))
+            for segment in segments
+        )
+        write_records(session, base, records, bulk=True, chunk_size=chunk_size)
+    session.close()
+
+
+def merge_databases(engine, paths, tables):
+    """Copy the rows of each table from every SQLite database in paths"""
+    with engine.connect() as connection:
+        for path in paths:
+            connection.execute("ATTACH DATABASE ? AS shard", (path,))
+            with connection.begin():
+                for table in tables:
+                    connection.execute(
+                        'INSERT INTO main."{0}" SELECT * FROM shard."{0}"'.format(table)
+                    )
+            connection.execute("DETACH DATABASE shard")
+
+
+def backup_database(engine, path):
+    """Copy the whole SQLite database behind engine to a file at path"""
+    connection = engine.raw_connection()
+    target = sqlite3.connect(path)
+    try:
+        with target:
+            connection.connection.backup(target)
+    finally:
+        target.close()
+        connection.close()
+
+
+class GenerateBDIData(BatchDataTask):
+    task_docs = BatchDataTask.task_docs + """
+    The records to generate are described by the recipe in the `recipe` option,
+    which defaults to recipe.yml next to the mapping file.
+    """
+
+    task_options = dict(
+        BatchDataTask.task_options,
+        recipe={
+            "description": "A generation recipe YAML file. Defaults to recipe.yml in the mapping file's directory.",
+            "required": False,
+        },
+    )
+
+    def _init_options(self, kwargs):
+        super(GenerateBDIData, self)._init_options(kwargs)
+        if not self.options.get("recipe"):
+            self.options["recipe"] = os.path.join(
+                os.path.dirname(self.options["mapping_yaml"]), "recipe.yml"
             )
+        self.options["recipe"] = os.path.abspath(self.options["recipe"])
+
+    def cache_key_files(self):
+        return [self.options["recipe"]]
 
-        make_records_import_table(account_adder,
-            npsp__Account1_Name__c = "Account%(i)d",
-            npsp__Donation_Amount__c = 200,
-            npsp__Donation_Donor__c = "Account1",
-            npsp__Do_Not_Automatically_Create_Payment__c = True
+    def generate_data(self, session, base):
+        self.session = session
+        self.base = base
+        segments = self.segments(session)
+        if self.options["workers"] > 1:
+            self.generate_shards(segments, self.options["workers"])
+        else:
+            # Write one table at a time, in mapping order, so that a
+            # pipelined load can start on the first tables early.
+            for table in self.table_order(segments):
+                if self.options["insert_mode"] == "sql":
+                    for segment in segments:
+                        if table in dict(segment.tables):
+                            segment.insert(
+                                session,
+                                table,
+                                segment.start,
+                                segment.count,
+                                self.options.get("chunk_size"),
+                            )
+                else:
+                    records = chain.from_iterable(
+                        segment.records(segment.start, segment.count, tables=[table])
+                        for segment in segments
+                    )
+                    write_records(
+                        session,
+                        base,
+                        records,
+                        bulk=self.options["insert_mode"] == "bulk",
+                        chunk_size=self.options.get("chunk_size"),
+                    )
+                self.table_generated(
+                    table,
+                    sum(
+                        segment.count - segment.start
+                        for segment in segments
+                        if table in dict(segment.tables)
+                    ),
+                )
+        self.session.commit()
+
+    def records(self):
+        segments = self.segments()
+        for table in self.table_order(segments):
+            for segment in segments:
+                yield from segment.records(segment.start, segment.count, tables=[table])
+
+    def segments(self, session=None):
+        recipe = Recipe(self.options["recipe"])
+        segments = list(
+            recipe.segments(int(self.options["num_records"]), self.previous_num_records)
+        )
+        high_water = None
+        if self.previous_num_records:
+            tables = OrderedDict.fromkeys(
+                table for segment in segments for table, _ in segment.tables
             )
-        contact_adder = Adder(1)
+            high_water = {table: max_id(session, table) for table in tables}
+        return plan_segments(segments, high_water)
+
+    def table_order(self, segments):
+        tables = [mapping["table"] for mapping in self.mappings.values()]
+        for segment in segments:
+            tables.extend(table for table, _ in segment.tables)
+        return list(OrderedDict.fromkeys(tables))
+
+    def generate_shards(self, segments, workers):
+        """Split every segment's rows across a process pool and merge the
+           resulting shards into this task's database"""
+        with tempfile.TemporaryDirectory() as tempdir:
+            paths = [
+                os.path.join(tempdir, "shard_{}.db".format(shard))
+                for shard in range(workers)
+            ]
+            with ProcessPoolExecutor(workers) as executor:
+                futures = [
+                    executor.submit(
+                        generate_shard,
+                        "sqlite:///" + path,
+                        self.mappings,
+                        segments,
+                        shard,
+                        workers,
+                        self.options.get("chunk_size"),
+                        self.pragmas,
+                        self.options["insert_mode"],
+                    )
+                    for shard, path in enumerate(paths)
+                ]
+                for future in futures:
+                    future.result()
+            self.logger.info("Merging {} shards".format(workers))
+            merge_databases(self.session.bind, paths, self.base.metadata.tables)
+        self.rows_generated += sum(
+            (segment.count - segment.start) * len(segment.tables) for segment in segments
+        )
+
+
+class GenerateData(BatchDataTask):
+    task_docs = BatchDataTask.task_docs + """
+    Generates data for any mapping file, such as datasets/mapping.yml, at any
+    scale.  `num_records` is the number of `unit_table` rows to generate and
+    every table gets as many rows per unit_table row as it has in
+    `template_db`.  Each mapping step's rows take their field values from
+    the template rows that step loads, in turn, and each of its lookups is
+    set as often as in those rows.
+    """
+
+    task_options = dict(
+        BatchDataTask.task_options,
+        template_db={
+            "description": "The dataset database to take table sizes, lookup fill rates and field values from. "
+            "Defaults to 1k/test_data.db in the mapping file's directory.",
+            "required": False,
+        },
+        unit_table={
+            "description": "The table num_records counts rows of. Defaults to contacts.",
+            "required": False,
+        },
+    )
 
-        make_records_import_table(contact_adder,
-            npsp__Contact1_Lastname__c = "Contact%(i)d",
-            npsp__Donation_Amount__c = 300,
-            npsp__Donation_Donor__c = "Contact1",
-            npsp__Do_Not_Automatically_Create_Payment__c = False
+    def _init_options(self, kwargs):
+        super(GenerateData, self)._init_options(kwargs)
+        if not self.options.get("template_db"):
+            self.options["template_db"] = os.path.join(
+                os.path.dirname(self.options["mapping_yaml"]), "1k", "test_data.db"
             )
+        self.options["template_db"] = os.path.abspath(self.options["template_db"])
+        if not os.path.isfile(self.options["template_db"]):
+            raise TaskOptionsError("No database at {}".format(self.options["template_db"]))
+        self.options["unit_table"] = self.options.get("unit_table") or "contacts"
+        if self.options["insert_mode"] == "sql":
+            raise TaskOptionsError("GenerateData supports insert_mode orm or bulk.")
+        if self.options["grow"] or self.options["workers"] > 1:
+            raise TaskOptionsError("GenerateData doesn't support the grow or workers options.")
 
-        make_records_import_table(contact_adder,
-            npsp__Contact1_Lastname__c = "Contact%(i)d",
-            npsp__Donation_Amount__c = 400,
-            npsp__Donation_Donor__c = "Contact1",
-            npsp__Do_Not_Automatically_Create_Payment__c = True
+    def generator_key(self, mapping_file_path, *extra):
+        return super(GenerateData, self).generator_key(
+            mapping_file_path, "unit_table={}".format(self.options["unit_table"]), *extra
+        )
+
+    def cache_key_files(self):
+        return [self.options["template_db"]]
+
+    def generate_data(self, session, base):
+        self.session = session
+        self.base = base
+        templates, counts = self.table_templates()
+        for template in templates.values():
+            write_records(
+                session,
+                base,
+                template.records(counts),
+                bulk=self.options["insert_mode"] == "bulk",
+                chunk_size=self.options.get("chunk_size"),
             )
+            self.table_generated(template.table, template.count)
+        session.commit()
+
+    def records(self):
+        templates, counts = self.table_templates()
+        for template in templates.values():
+            yield from template.records(counts)
+
+    def table_templates(self):
+        """Build a TableTemplate for each table, in mapping order, along
+           with the number of rows each will generate"""
+        metadata = MetaData()
+        for mapping in self.mappings.values():
+            create_table(mapping, metadata, set())
+        connection = sqlite3.connect(self.options["template_db"])
+        try:
+            try:
+                units = count_template_rows(connection, self.options["unit_table"])
+            except sqlite3.OperationalError:
+                units = 0
+            if not units:
+                raise TaskOptionsError(
+                    "{} has no {} rows to scale from.".format(
+                        self.options["template_db"], self.options["unit_table"]
+                    )
+                )
+            scale = Fraction(int(self.options["num_records"]), units)
+            templates = OrderedDict()
+            for mapping in self.mappings.values():
+                table = mapping["table"]
+                if table not in templates:
+                    templates[table] = TableTemplate(metadata.tables[table])
+                templates[table].add_step(connection, mapping, scale)
+        finally:
+            connection.close()
+        counts = {table: template.count for table, template in templates.items()}
+        for template in templates.values():
+            for step in template.steps:
+                for column, target, _, _ in step["lookups"]:
+                    if target not in counts:
+                        raise TaskOptionsError(
+                            "The lookup column {}.{} points at {}, which no mapping step loads.".format(
+                                template.table, column, target
+                            )
+                        )
+        return templates, counts
+
+
+class TableTemplate:
+    """Synthesizes the rows of one table from a template database.  Each
+       mapping step that loads the table gets its own run of rows, which
+       repeat the field values of the template rows that step loads.  Each
+       of the step's lookups is set as often as in those template rows and
+       points at rows spread evenly over the target table, so rows that
+       share a parent are next to each other."""
+
+    def __init__(self, table):
+        self.table = table.name
+        key = table.primary_key.columns.values()[0]
+        self.key = key.name
+        self.key_type = int if isinstance(key.type, Integer) else str
+        self.steps = []
+        self.count = 0
+
+    def add_step(self, connection, mapping, scale):
+        """Add the rows of a mapping step, scaling the number of template
+           rows it loads by scale"""
+        columns = {
+            row[1]: row[2].upper()
+            for row in connection.execute('PRAGMA table_info("{}")'.format(self.table))
+        }
+        rows = 0
+        if columns:
+            where = " AND ".join(
+                "({})".format(f) for f in load_filters(mapping, columns)
+            ) or "1"
+            rows = count_template_rows(connection, self.table, where)
+        values = OrderedDict()
+        for field in mapping.get("fields", {}).values():
+            if field == self.key:
+                continue
+            values[field] = []
+            if field in columns:
+                values[field] = [
+                    template_value(value, "DATE" in columns[field])
+                    for (value,) in connection.execute(
+                        'SELECT "{}" FROM "{}" WHERE {} ORDER BY rowid'.format(
+                            field, self.table, where
+                        )
+                    )
+                ]
+        lookups = []
+        for sf_field, lookup in mapping.get("lookups", {}).items():
+            column = get_lookup_key_field(lookup, sf_field)
+            filled = rows
+            if column in columns:
+                filled = count_template_rows(connection, self.table, where, column)
+            lookups.append((column, lookup["table"], filled, rows))
+        count = math.floor(rows * scale)
+        self.steps.append(
+            {
+                "count": count,
+                "record_type": mapping.get("record_type"),
+                "values": values,
+                "lookups": lookups,
+            }
+        )
+        self.count += count
+
+    def records(self, counts):
+        """Yield (table name, fields) for every row, given the number of
+           rows of each table"""
+        key = 0
+        for step in self.steps:
+            # Row j of the step sets a lookup when j * filled / rows passes
+            # a whole number, so that the lookup is set for the same share
+            # of rows as in the template.  The first lookup's targets are
+            # spread evenly over the target table, keeping rows with the
+            # same parent together.  The others cycle through their target
+            # table, so that pairs such as a campaign member's contact and
+            # campaign don't repeat, starting at different rows for lookups
+            # to the same table so that a relationship's contact isn't also
+            # its related contact.
+            targets = defaultdict(list)
+            for column, target, _, _ in step["lookups"]:
+                targets[target].append(column)
+            lookups = [
+                (
+                    column,
+                    filled,
+                    rows,
+                    counts[target],
+                    step["count"] * filled // rows if position == 0 else None,
+                    counts[target] * targets[target].index(column) // len(targets[target]),
+                )
+                for position, (column, target, filled, rows) in enumerate(step["lookups"])
+                if rows
+            ]
+            for j in range(step["count"]):
+                key += 1
+                fields = {self.key: self.key_type(key)}
+                for column, values in step["values"].items():
+                    fields[column] = (
+                        values[j % len(values)] if values else "{} {}".format(column, key)
+                    )
+                for column, filled, rows, target_rows, spread, offset in lookups:
+                    index = j * filled // rows
+                    fields[column] = None
+                    if (j + 1) * filled // rows > index and target_rows:
+                        target = index * target_rows // spread if spread else index
+                        fields[column] = str((target + offset) % target_rows + 1)
+                if step["record_type"]:
+                    fields["record_type"] = step["record_type"]
+                yield self.table, fields
+
+
+def count_template_rows(connection, table, where="1", column=None):
+    """Count a template table's rows, or its non-null values of column"""
+    counted = '"{}"'.format(column) if column else "*"
+    return next(
+        connection.execute(
+            'SELECT COUNT({}) FROM "{}" WHERE {}'.format(counted, table, where)
+        )
+    )[0]
+
+
+def template_value(value, date_column=False):
+    """A template database value to generate, with dates stored as epoch
+       milliseconds turned into ISO dates"""
+    if date_column and isinstance(value, (int, float)):
+        return datetime.utcfromtimestamp(value / 1000).date().isoformat()
+    return value
+
 
-        self.session.flush()
+def load_lookups(mapping):
+    """The lookups LoadData resolves when it first loads a mapping step,
+       leaving out dependent lookups with an `after:`"""
+    return OrderedDict(
+        (sf_field, lookup)
+        for sf_field, lookup in mapping.get("lookups", {}).items()
+        if "after" not in lookup
+    )
+
+
+def load_order(mapping):
+    """The ORDER BY terms of LoadData's query for a mapping step"""
+    return [
+        '"{}"'.format(get_lookup_key_field(lookup, sf_field))
+        for sf_field, lookup in load_lookups(mapping).items()
+    ]
+
+
+def load_filters(mapping, columns=None):
+    """The WHERE terms of LoadData's query for a mapping step.  Like LoadData,
+       only filter on record_type if the table has that column, when the
+       table's columns are given."""
+    filters = list(mapping.get("filters", []))
+    if "record_type" in mapping and (columns is None or "record_type" in columns):
+        filters.append("record_type = '{}'".format(mapping["record_type"]))
+    return filters
+
+
+def update_steps(mappings):
+    """The names LoadData gives the update steps it runs for `after:`
+       lookups, and the step whose records each updates, by the step they
+       run after"""
+    updates = defaultdict(OrderedDict)
+    for name, mapping in mappings.items():
+        for after in sorted(
+            {
+                lookup["after"]
+                for lookup in mapping.get("lookups", {}).values()
+                if "after" in lookup
+            }
+        ):
+            update = "Update {} Dependencies After {}".format(mapping["sf_object"], after)
+            updates[after][update] = name
+    return updates
+
+
+def order_table_by_parent(mapping, mappings, connection):
+    """Renumber a table's rows in the order LoadData queries them and
+       update the lookups in other tables that point at those rows"""
+    order = load_order(mapping)
+    if not order:
+        return
+    table = mapping["table"]
+    connection.execute("DROP TABLE IF EXISTS temp.renumber")
+    connection.execute(
+        "CREATE TEMP TABLE renumber (old_id INTEGER PRIMARY KEY, new_id INTEGER)"
+    )
+    connection.execute(
+        'INSERT INTO temp.renumber SELECT id, (SELECT MIN(id) FROM "{0}") - 1 + '
+        'ROW_NUMBER() OVER (ORDER BY {1}, id) FROM "{0}"'.format(
+            table, ", ".join(order)
+        )
+    )
+    # Move every id out of the way first so that no new id collides with
+    # an old one that has not been renumbered yet
+    connection.execute('UPDATE "{}" SET id = -id'.format(table))
+    connection.execute(
+        'UPDATE "{0}" SET id = '
+        '(SELECT new_id FROM temp.renumber WHERE old_id = -"{0}".id)'.format(table)
+    )
+    for child in mappings.values():
+        for sf_field, lookup in child.get("lookups", {}).items():
+            if lookup["table"] == table:
+                connection.execute(
+                    'UPDATE "{0}" SET "{1}" = '
+                    '(SELECT new_id FROM temp.renumber WHERE old_id = "{0}"."{1}") '
+                    'WHERE "{1}" IS NOT NULL'.format(
+                        child["table"], get_lookup_key_field(lookup, sf_field)
+                    )
+                )
+    connection.execute("DROP TABLE temp.renumber")
+
+
+def lookup_contention(mapping, connection, batch_size=LOAD_BATCH_SIZE):
+    """For each lookup of a mapping step, count the Bulk API batches that
+       LoadData's query order puts each parent's children in.  Children of
+       a parent that are split across batches can lock it in parallel."""
+    order = load_order(mapping) + [
+        '"{}"'.format(mapping.get("fields", {}).get("Id") or "id")
+    ]
+    filters = load_filters(mapping)
+    where = " WHERE " + " AND ".join(filters) if filters else ""
+    for sf_field, lookup in load_lookups(mapping).items():
+        column = get_lookup_key_field(lookup, sf_field)
+        batches = (
+            'SELECT parent, COUNT(DISTINCT batch) AS batches FROM ('
+            'SELECT "{column}" AS parent, '
+            "(ROW_NUMBER() OVER (ORDER BY {order}) - 1) / {batch_size} AS batch "
+            'FROM "{table}"{where}) '
+            "WHERE parent IS NOT NULL GROUP BY parent".format(
+                column=column,
+                order=", ".join(order),
+                batch_size=int(batch_size),
+                table=mapping["table"],
+                where=where,
+            )
+        )
+        distribution = OrderedDict(
+            (batch_count, parents)
+            for batch_count, parents in connection.execute(
+                "SELECT batches, COUNT(*) FROM ({}) GROUP BY batches "
+                "ORDER BY batches".format(batches)
+            )
+        )
+        worst = connection.execute(
+            "SELECT parent, batches FROM ({}) WHERE batches > 1 "
+            "ORDER BY batches DESC, parent LIMIT 10".format(batches)
+        )
+        yield {
+            "lookup": sf_field,
+            "table": lookup["table"],
+            "parents": sum(distribution.values()),
+            "shared_parents": sum(
+                parents
+                for batch_count, parents in distribution.items()
+                if batch_count > 1
+            ),
+            "max_batches": max(distribution, default=0),
+            "parents_by_batch_count": distribution,
+            "most_shared_parents": [
+                {"parent": parent, "batches": batch_count}
+                for parent, batch_count in worst
+            ],
+        }
 
 
 # Note: code below here is taken from cumulusci.tasks.bulkdata.QueryData,
 # and really we should refactor it there to be more reusable.
 
 
-def init_db(db_url, mappings):
+def init_db(db_url, mappings, pragmas=(), timings=None, reuse_tables=False):
+    timings = timings or Timings()
     engine = create_engine(db_url)
+    if pragmas:
+        set_pragmas(engine, pragmas)
     metadata = MetaData()
     metadata.bind = engine
-    for mapping in mappings.values():
-        create_table(mapping, metadata)
-    metadata.create_all()
-    base = automap_base(bind=engine, metadata=metadata)
-    base.prepare(engine, reflect=True)
+    with timings.phase("schema"):
+        existing_tables = set(engine.table_names())
+        for mapping in mappings.values():
+            create_table(mapping, metadata, set() if reuse_tables else existing_tables)
+        # Create every table in one transaction, without checking for each
+        # one again
+        with engine.begin() as connection:
+            metadata.create_all(
+                connection,
+                tables=[
+                    table
+                    for table in metadata.sorted_tables
+                    if table.name not in existing_tables
+                ],
+                checkfirst=False,
+            )
+    with timings.phase("automap"):
+        # Map classes straight from the tables just defined rather than
+        # reflecting them back out of the database
+        base = automap_base(bind=engine, metadata=metadata)
+        base.prepare()
     session = create_session(bind=engine, autocommit=False)
     return session, base
 
 
-def create_table(mapping, metadata):
+def read_generation_state(sqlite_path):
+    """The generation state recorded in a database, or None if it has none.
+       Raises TaskOptionsError for a database with tables but no state."""
+    if not os.path.exists(sqlite_path):
+        return None
+    connection = sqlite3.connect(sqlite_path)
+    try:
+        tables = {
+            name
+            for (name,) in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            )
+        }
+        if GENERATION_STATE_TABLE not in tables:
+            if tables:
+                raise TaskOptionsError(
+                    "{} has no {} table to grow it from.".format(
+                        sqlite_path, GENERATION_STATE_TABLE
+                    )
+                )
+            return None
+        return dict(
+            connection.execute('SELECT name, value FROM "{}"'.format(GENERATION_STATE_TABLE))
+        )
+    finally:
+        connection.close()
+
+
+def write_generation_state(session, state):
+    """Record how a database was generated, so that it can be grown later"""
+    session.execute(
+        'CREATE TABLE IF NOT EXISTS "{}" '
+        "(name VARCHAR(255) PRIMARY KEY, value VARCHAR(255))".format(GENERATION_STATE_TABLE)
+    )
+    for name, value in state.items():
+        session.execute(
+            text(
+                'INSERT OR REPLACE INTO "{}" (name, value) VALUES (:name, :value)'.format(
+                    GENERATION_STATE_TABLE
+                )
+            ),
+            {"name": name, "value": value},
+        )
+
+
+def set_pragmas(engine, pragmas):
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute("PRAGMA " + pragma)
+        cursor.close()
+
+
+def create_table(mapping, metadata, existing_tables=None):
     table_kwargs = {}
+    # Several mapping steps can load the same table, such as the household
+    # and organization contacts in datasets/mapping.yml; each adds its
+    # columns to the table the first one defined
+    if mapping["table"] in metadata.tables:
+        table_kwargs["extend_existing"] = True
 
     # Provide support for legacy mappings which used the OID as the pk but
     # default to using an autoincrementing int pk and a separate sf_id column
@@ -394,10 +1972,30 @@ def create_table(mapping, metadata):
     if "record_type" in mapping:
         fields.append(Column("record_type", Unicode(255)))
     t = Table(mapping["table"], metadata, *fields, **table_kwargs)
-    if t.exists():
+    if existing_tables is None:
+        exists = t.exists()
+    else:
+        exists = t.name in existing_tables
+    if exists:
         raise Exception("Table already exists: {}".format(mapping["table"]))
 
 
+def create_lookup_indexes(mapping, metadata, bind):
+    """Index a mapping's lookup key columns, named <table>_<column> like the
+       indexes in datasets/1k/test_data.db.  Indexes already in the
+       database are skipped, even when metadata does not know about them,
+       so this is safe to call after the table is populated, for tables
+       shared by several mappings and for a database being grown."""
+    table = metadata.tables[mapping["table"]]
+    for sf_field, lookup in mapping.get("lookups", {}).items():
+        column = table.columns[get_lookup_key_field(lookup, sf_field)]
+        bind.execute(
+            'CREATE INDEX IF NOT EXISTS "{0}_{1}" ON "{0}" ("{1}")'.format(
+                table.name, column.name
+            )
+        )
+
+
 def fields_for_mapping(mapping):
     fields = []
     for sf_field, db_field in mapping.get("fields", {}).items():
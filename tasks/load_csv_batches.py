@@ -0,0 +1,176 @@
+import csv
+import gzip
+import io
+import os
+import re
+from collections import defaultdict
+from cumulusci.tasks.salesforce import BaseSalesforceApiTask
+from cumulusci.tasks.bulkdata.utils import BulkJobTaskMixin
+from cumulusci.tasks.bulkdata.utils import download_file
+from cumulusci.core.exceptions import BulkDataException
+from cumulusci.core.utils import ordered_yaml_load
+from cumulusci.core.utils import process_bool_arg
+
+
+def step_directory(index, name):
+    """The directory that holds the CSV batches of the index'th mapping step"""
+    return "{:02d}_{}".format(index + 1, re.sub(r"\W+", "_", name))
+
+
+class LoadCSVBatches(BulkJobTaskMixin, BaseSalesforceApiTask):
+    task_docs = """
+    Upload the CSV batch files that a BatchDataTask writes with
+    `output_format: csv`, or that ExportCSVBatches exports from a dataset
+    database (gzipped batches are read as they are).  Each mapping step's batches go to one Bulk API
+    job.  Lookup columns hold local keys, which are replaced with the
+    Salesforce Ids of the records inserted by earlier steps.
+    """
+
+    task_options = {
+        "csv_dir": {
+            "description": "The directory of CSV batches to upload",
+            "required": True,
+        },
+        "mapping": {
+            "description": "The mapping file the CSV batches were written for",
+            "required": True,
+        },
+        "ignore_row_errors": {
+            "description": "If True, allow the load to continue even if individual rows fail to load."
+        },
+    }
+
+    rows_loaded = 0
+
+    def _init_options(self, kwargs):
+        super(LoadCSVBatches, self)._init_options(kwargs)
+        self.options["ignore_row_errors"] = process_bool_arg(
+            self.options.get("ignore_row_errors", False)
+        )
+
+    def _run_task(self):
+        with open(self.options["mapping"], "r") as f:
+            self.mapping = ordered_yaml_load(f)
+        self.sf_ids = defaultdict(dict)
+        directories = {
+            name: os.path.join(self.options["csv_dir"], step_directory(index, name))
+            for index, name in enumerate(self.mapping)
+        }
+        for name, mapping in self.mapping.items():
+            self.logger.info("Running Job: {}".format(name))
+            self._load_step(name, directories[name], mapping)
+            # Dependent lookups are set with an update once their target
+            # has been loaded, as LoadData does
+            for step_name, step in self.mapping.items():
+                lookups = [
+                    sf_field
+                    for sf_field, lookup in step.get("lookups", {}).items()
+                    if lookup.get("after") == name
+                ]
+                if lookups:
+                    self.logger.info(
+                        "Running post-load step: Update {} Dependencies After {}".format(
+                            step["sf_object"], name
+                        )
+                    )
+                    self._load_step(
+                        step_name, directories[step_name], step, update_lookups=lookups
+                    )
+
+    def _load_step(self, name, directory, mapping, update_lookups=None):
+        action = "update" if update_lookups else mapping.get("action", "insert")
+        if action == "insert":
+            job_id = self.bulk.create_insert_job(mapping["sf_object"], contentType="CSV")
+        else:
+            job_id = self.bulk.create_update_job(mapping["sf_object"], contentType="CSV")
+        self.logger.info("  Created bulk job {}".format(job_id))
+        statics = [] if update_lookups else self._get_statics(mapping)
+        local_ids_for_batch = {}
+        for batch_name in sorted(os.listdir(directory)):
+            batch_file, local_ids = self._prepare_batch(
+                os.path.join(directory, batch_name), mapping, statics, update_lookups
+            )
+            batch_id = self.bulk.post_batch(job_id, batch_file)
+            local_ids_for_batch[batch_id] = local_ids
+            self.logger.info("    Uploaded batch {}".format(batch_id))
+        self.bulk.close_job(job_id)
+        result = self._wait_for_job(job_id)
+        if result != "Completed":
+            raise BulkDataException("Job {} did not complete successfully".format(name))
+        for batch_id, local_ids in local_ids_for_batch.items():
+            self._process_batch_results(mapping, job_id, batch_id, local_ids, action)
+
+    def _prepare_batch(self, path, mapping, statics, update_lookups=None):
+        """Read a batch file and return it ready for upload, with lookups
+           resolved to Salesforce Ids, along with the local keys of its rows"""
+        lookups = mapping.get("lookups", {})
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", newline="", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            header = next(reader)[1:]
+            if update_lookups:
+                keep = [sf_field in update_lookups for sf_field in header]
+                columns = ["Id"] + [
+                    sf_field for sf_field in header if sf_field in update_lookups
+                ]
+            else:
+                keep = [
+                    "after" not in lookups.get(sf_field, {}) for sf_field in header
+                ]
+                columns = [sf_field for sf_field, kept in zip(header, keep) if kept]
+                columns += list(mapping.get("static", {}).keys())
+                if mapping.get("record_type"):
+                    columns.append("RecordTypeId")
+            resolvers = [
+                self.sf_ids[lookups[sf_field]["table"]] if sf_field in lookups else None
+                for sf_field in header
+            ]
+            text = io.StringIO()
+            writer = csv.writer(text)
+            writer.writerow(columns)
+            local_ids = []
+            for row in reader:
+                local_id = row[0]
+                values = [
+                    resolver.get(value, "") if resolver is not None and value else value
+                    for value, resolver, kept in zip(row[1:], resolvers, keep)
+                    if kept
+                ]
+                if update_lookups:
+                    values = [self.sf_ids[mapping["table"]].get(local_id, "")] + values
+                writer.writerow(values + statics)
+                local_ids.append(local_id)
+        return io.BytesIO(text.getvalue().encode("utf-8")), local_ids
+
+    def _get_statics(self, mapping):
+        statics = list(mapping.get("static", {}).values())
+        if mapping.get("record_type"):
+            query = (
+                "SELECT Id FROM RecordType WHERE SObjectType='{0}'"
+                "AND DeveloperName = '{1}' LIMIT 1"
+            )
+            record_type_id = self.sf.query(
+                query.format(mapping.get("sf_object"), mapping["record_type"])
+            )["records"][0]["Id"]
+            statics.append(record_type_id)
+        return statics
+
+    def _process_batch_results(self, mapping, job_id, batch_id, local_ids, action):
+        """Check a batch's results and remember the Ids of inserted records"""
+        results_url = "{}/job/{}/batch/{}/result".format(
+            self.bulk.endpoint, job_id, batch_id
+        )
+        sf_ids = self.sf_ids[mapping["table"]]
+        with download_file(results_url, self.bulk) as f:
+            reader = csv.reader(io.TextIOWrapper(f, encoding="utf-8"))
+            next(reader)  # skip header
+            for i, (row, local_id) in enumerate(zip(reader, local_ids)):
+                if row[1] == "true":
+                    if action == "insert":
+                        sf_ids[local_id] = row[0]
+                    self.rows_loaded += 1
+                elif self.options["ignore_row_errors"]:
+                    self.logger.warning("      Error on row {}: {}".format(i, row[3]))
+                else:
+                    raise BulkDataException("Error on row {}: {}".format(i, row[3]))
+        self.logger.info("  Processed results for batch {}".format(batch_id))
@@ -0,0 +1,220 @@
+import threading
+from collections import defaultdict
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from cumulusci.tasks.bulkdata import LoadData
+from cumulusci.core.exceptions import BulkDataException
+from cumulusci.core.utils import process_bool_arg
+
+from tasks.generate_bdi_data import LOAD_BATCH_SIZE
+from tasks.generate_bdi_data import PipelinedLoadData
+from tasks.generate_bdi_data import load_lookups
+from tasks.generate_bdi_data import update_steps
+from tasks.validate_dataset import load_estimates
+from tasks.validate_dataset import read_throughput
+
+
+class ParallelLoadData(PipelinedLoadData):
+    task_docs = """
+    Load a dataset like LoadData, but run mapping steps that do not depend
+    on each other at the same time, up to `workers` at once.  A step waits
+    for every earlier step that loads a table it looks up, so that it finds
+    their Salesforce Ids.  The updates LoadData runs for `after:` lookups
+    wait for the step they are after and the step whose records they
+    update.  Steps that look up the same records can still contend for
+    locks on them in the org; lower `workers` if they do.
+
+    With `dry_run`, nothing is loaded.  The stages of steps that can run
+    together are logged, along with the chain of steps that bounds the
+    load time however many workers run it.  The time is estimated from the
+    rows of each step and a throughput profile like ValidateDataset's.
+    """
+
+    task_options = dict(
+        LoadData.task_options,
+        workers={
+            "description": "The most mapping steps to load at once. Defaults to 4.",
+            "required": False,
+        },
+        dry_run={
+            "description": "If True, log the stages and critical path without loading anything.",
+            "required": False,
+        },
+        throughput={
+            "description": "A YAML file of the records per second to estimate each sObject's "
+            "load time with for dry_run. Defaults to 200 for every sObject.",
+            "required": False,
+        },
+    )
+
+    def _init_options(self, kwargs):
+        super(ParallelLoadData, self)._init_options(kwargs)
+        self.options["workers"] = int(self.options.get("workers") or 4)
+        self.options["dry_run"] = process_bool_arg(self.options.get("dry_run", False))
+
+    def _run_task(self):
+        self._init_mapping()
+        self._init_db()
+        self._expand_mapping()
+        dependencies = load_dependencies(self.mapping)
+        if self.options["dry_run"]:
+            self._log_plan(dependencies)
+            return
+        steps = OrderedDict(self.mapping)
+        for updates in self.after_steps.values():
+            steps.update(updates)
+        # Steps before start_step and their updates are skipped, as LoadData
+        # skips them
+        done = set()
+        start_step = self.options.get("start_step")
+        if start_step:
+            for name in self.mapping:
+                if name == start_step:
+                    break
+                self.logger.info("Skipping step: {}".format(name))
+                done.add(name)
+                done.update(self.after_steps.get(name, ()))
+        self.db_lock = threading.RLock()
+        # A SQLite connection can't move between threads, so the session is
+        # closed after each use under db_lock, starting with _init_db's
+        self.session.close()
+        running = {}
+        with ThreadPoolExecutor(self.options["workers"]) as executor:
+            try:
+                while len(done) < len(dependencies):
+                    for name, depends in dependencies.items():
+                        if (
+                            name not in done
+                            and name not in running.values()
+                            and all(dependency in done for dependency in depends)
+                        ):
+                            future = executor.submit(self._load_step, name, steps[name])
+                            running[future] = name
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        name = running.pop(future)
+                        if future.result() != "Completed":
+                            raise BulkDataException(
+                                "Job {} did not complete successfully".format(name)
+                            )
+                        done.add(name)
+            except Exception:
+                for future in running:
+                    future.cancel()
+                raise
+
+    def _load_step(self, name, mapping):
+        self.logger.info("Running Job: {}".format(name))
+        return self._load_mapping(mapping)
+
+    def _log_plan(self, dependencies):
+        seconds = {
+            step["name"]: step["seconds"]
+            for step in load_estimates(
+                self.session.connection(),
+                self.mapping,
+                read_throughput(self.options.get("throughput")),
+            )
+        }
+        for number, stage in enumerate(load_stages(dependencies), 1):
+            self.logger.info(
+                "Stage {}, about {:.0f}s: {}".format(
+                    number, max(seconds[name] for name in stage), ", ".join(stage)
+                )
+            )
+        total, path = critical_path(dependencies, seconds)
+        self.logger.info(
+            "Critical path, about {:.1f} of {:.1f} minutes loading one step at a "
+            "time: {}".format(total / 60, sum(seconds.values()) / 60, " -> ".join(path))
+        )
+
+    def _get_batches(self, mapping, batch_size=LOAD_BATCH_SIZE):
+        # Read all of a step's batches while holding the database so that
+        # other steps can use it while this one uploads them
+        with self.db_lock:
+            try:
+                return list(
+                    super(ParallelLoadData, self)._get_batches(mapping, batch_size)
+                )
+            finally:
+                self.session.close()
+
+    def _process_job_results(self, mapping, job_id, local_ids_for_batch):
+        with self.db_lock:
+            try:
+                super(ParallelLoadData, self)._process_job_results(
+                    mapping, job_id, local_ids_for_batch
+                )
+            finally:
+                self.session.close()
+
+    def _step_loaded(self, mapping, seconds):
+        with self.db_lock:
+            super(ParallelLoadData, self)._step_loaded(mapping, seconds)
+
+
+def load_dependencies(mappings):
+    """The steps LoadData runs for a mapping, in its order, with the steps
+       each has to wait for.  A step waits for the earlier steps that load
+       the tables it looks up.  An update step waits for the step it runs
+       after, the step whose records it updates and the steps that load the
+       tables of the lookups it sets."""
+    updates = update_steps(mappings)
+    loaded_by = defaultdict(list)
+    dependencies = OrderedDict()
+    for name, mapping in mappings.items():
+        depends = OrderedDict()
+        for lookup in load_lookups(mapping).values():
+            depends.update(OrderedDict.fromkeys(loaded_by[lookup["table"]]))
+        dependencies[name] = list(depends)
+        loaded_by[mapping["table"]].append(name)
+        for update, step in updates[name].items():
+            depends = OrderedDict.fromkeys([name, step])
+            for lookup in mappings[step]["lookups"].values():
+                if lookup.get("after") == name:
+                    depends.update(OrderedDict.fromkeys(loaded_by[lookup["table"]]))
+            dependencies[update] = list(depends)
+    return dependencies
+
+
+def load_stages(dependencies):
+    """Group steps into stages that could each run at once, a step's stage
+       being the one after the latest stage of the steps it waits for"""
+    stages = {}
+
+    def stage(name):
+        if name not in stages:
+            stages[name] = 1 + max(
+                (stage(dependency) for dependency in dependencies[name]), default=-1
+            )
+        return stages[name]
+
+    grouped = defaultdict(list)
+    for name in dependencies:
+        grouped[stage(name)].append(name)
+    return [grouped[number] for number in sorted(grouped)]
+
+
+def critical_path(dependencies, seconds):
+    """The chain of steps that takes longest given each step's seconds,
+       which no number of workers can load faster, and its seconds"""
+    finish = {}
+    previous = {}
+
+    def visit(name):
+        if name not in finish:
+            start = 0
+            for dependency in dependencies[name]:
+                if visit(dependency) > start:
+                    start = finish[dependency]
+                    previous[name] = dependency
+            finish[name] = start + seconds.get(name, 0)
+        return finish[name]
+
+    last = max(dependencies, key=visit)
+    path = [last]
+    while path[-1] in previous:
+        path.append(previous[path[-1]])
+    return finish[last], path[::-1]
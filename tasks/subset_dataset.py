@@ -0,0 +1,152 @@
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from cumulusci.core.tasks import BaseTask
+from cumulusci.core.exceptions import TaskOptionsError
+from cumulusci.core.utils import ordered_yaml_load
+
+from tasks.generate_bdi_data import attached_table
+from tasks.generate_bdi_data import column_affinity
+from tasks.generate_bdi_data import copy_ddl
+from tasks.generate_bdi_data import get_lookup_key_field
+
+
+class SubsetDataset(BaseTask):
+    task_docs = """
+    Extract a smaller dataset from a large one, such as datasets/1k or
+    datasets/100k, for a dev or scratch org.  The subset starts from the
+    first `num_roots` rows of `root_table` and takes every row that looks
+    them up, directly or through other lookups in the mapping file, along
+    with every row those rows look up, so that no lookup in the subset
+    points at a row that is missing from it.
+    """
+
+    task_options = {
+        "source_db": {"description": "The dataset database to take a subset of", "required": True},
+        "mapping": {"description": "The mapping file the dataset is loaded with", "required": True},
+        "database": {"description": "The path to write the subset to", "required": True},
+        "num_roots": {"description": "How many root_table rows to start from", "required": True},
+        "root_table": {
+            "description": "The table to start from. Defaults to households.",
+            "required": False,
+        },
+    }
+
+    def _init_options(self, kwargs):
+        super(SubsetDataset, self)._init_options(kwargs)
+        if not os.path.isfile(self.options["source_db"]):
+            raise TaskOptionsError("No database at {}".format(self.options["source_db"]))
+        if os.path.exists(self.options["database"]):
+            raise TaskOptionsError(
+                "{} already exists; delete it first.".format(self.options["database"])
+            )
+        self.options["num_roots"] = int(self.options["num_roots"])
+        if self.options["num_roots"] < 1:
+            raise TaskOptionsError("num_roots must be at least 1")
+        self.options["root_table"] = self.options.get("root_table") or "households"
+
+    def _run_task(self):
+        with open(self.options["mapping"], "r") as f:
+            mappings = ordered_yaml_load(f)
+        if self.options["root_table"] not in {m["table"] for m in mappings.values()}:
+            raise TaskOptionsError(
+                "No mapping step loads the {} table".format(self.options["root_table"])
+            )
+        directory = os.path.dirname(self.options["database"])
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        start = time.perf_counter()
+        rows = subset_dataset(
+            self.options["source_db"],
+            self.options["database"],
+            mappings,
+            self.options["root_table"],
+            self.options["num_roots"],
+        )
+        for table, count in rows.items():
+            self.logger.info("  {}: {} rows".format(table, count))
+        self.logger.info(
+            "Wrote {} rows to {} in {:.2f}s".format(
+                sum(rows.values()), self.options["database"], time.perf_counter() - start
+            )
+        )
+
+
+def subset_dataset(source_path, path, mappings, root_table, num_roots):
+    """Write the rows of the SQLite database at source_path that are needed
+       for the first num_roots rows of root_table to a new database at path
+       and return the number of rows written for each table.
+
+       The keys of the rows to keep are collected in temporary tables.
+       Each pass over the lookups joins the keys found so far to the
+       lookup's indexed key column in the source, first adding the rows
+       that look up kept rows until no more are found and then the rows
+       that kept rows look up."""
+    tables = OrderedDict((mapping["table"], None) for mapping in mappings.values())
+    lookups = OrderedDict(
+        ((mapping["table"], get_lookup_key_field(lookup, sf_field), lookup["table"]), None)
+        for mapping in mappings.values()
+        for sf_field, lookup in mapping.get("lookups", {}).items()
+    )
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute("ATTACH DATABASE ? AS source", (source_path,))
+        columns = {}
+        keys = {}
+        for table in tables:
+            columns[table], keys[table] = attached_table(connection, "source", table)
+            connection.execute(
+                'CREATE TEMP TABLE "keep_{}" (key {} PRIMARY KEY)'.format(
+                    table, columns[table][keys[table]]
+                )
+            )
+        connection.execute(
+            'INSERT INTO temp."keep_{0}" SELECT "{1}" FROM source."{0}" '
+            'ORDER BY "{1}" LIMIT ?'.format(root_table, keys[root_table]),
+            (num_roots,),
+        )
+        # CROSS JOIN makes SQLite loop over the kept keys and look each one
+        # up in the source table's index
+        dependents = []
+        references = []
+        for child, column, parent in lookups:
+            key = "kept.key"
+            if column_affinity(columns[child][column]) == "TEXT":
+                key = "CAST(kept.key AS TEXT)"
+            dependents.append(
+                'INSERT OR IGNORE INTO temp."keep_{0}" SELECT row."{1}" '
+                'FROM temp."keep_{2}" AS kept CROSS JOIN source."{0}" AS row '
+                'ON row."{3}" = {4}'.format(child, keys[child], parent, column, key)
+            )
+            references.append(
+                'INSERT OR IGNORE INTO temp."keep_{2}" SELECT row."{3}" '
+                'FROM temp."keep_{0}" AS kept CROSS JOIN source."{0}" AS row '
+                'ON row."{1}" = kept.key '
+                'WHERE row."{3}" IS NOT NULL AND row."{3}" != \'\''.format(
+                    child, keys[child], parent, column
+                )
+            )
+        for statements in (dependents, references):
+            while True:
+                changes = connection.total_changes
+                for statement in statements:
+                    connection.execute(statement)
+                if connection.total_changes == changes:
+                    break
+        rows = OrderedDict()
+        with connection:
+            copy_ddl(connection, "source", tables, "table")
+            for table in tables:
+                changes = connection.total_changes
+                connection.execute(
+                    'INSERT INTO main."{0}" SELECT * FROM source."{0}" '
+                    'WHERE "{1}" IN (SELECT key FROM temp."keep_{0}")'.format(
+                        table, keys[table]
+                    )
+                )
+                rows[table] = connection.total_changes - changes
+            copy_ddl(connection, "source", tables, "index")
+        return rows
+    finally:
+        connection.close()
@@ -0,0 +1,142 @@
+import csv
+import io
+import itertools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+
+from cumulusci.core.config import OrgConfig
+
+JOB_NS = "http://www.force.com/2009/06/asyncapi/dataload"
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MockBulkAPI:
+    """Stands in for the SalesforceBulk client LoadData uses.  Every record
+    posted is accepted, and the batch states and results that LoadData
+    downloads with requests are served over HTTP from a local endpoint,
+    so LoadData's own result handling runs unchanged.  Each call is
+    recorded in `events` with the time it was made."""
+
+    jobNS = JOB_NS
+
+    def __init__(self, post_delay=0):
+        self.post_delay = post_delay
+        self.jobs = {}
+        self.events = []
+        self.start_time = time.time()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.endpoint = "http://127.0.0.1:{}".format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def record(self, *event):
+        self.events.append((time.time() - self.start_time,) + event)
+
+    def create_insert_job(self, sf_object, contentType=None):
+        return self.create_job("insert", sf_object)
+
+    def create_update_job(self, sf_object, contentType=None):
+        return self.create_job("update", sf_object)
+
+    def create_job(self, action, sf_object):
+        with self.lock:
+            job_id = "750{:015d}".format(next(self.ids))
+            self.jobs[job_id] = {"sf_object": sf_object, "batches": {}}
+        self.record("create job", action, sf_object)
+        return job_id
+
+    def post_batch(self, job_id, batch_file):
+        rows = list(csv.reader(io.StringIO(batch_file.read().decode("utf-8"))))[1:]
+        time.sleep(self.post_delay)
+        with self.lock:
+            batch_id = "751{:015d}".format(next(self.ids))
+            sf_ids = ["001{:015d}".format(next(self.ids)) for row in rows]
+            self.jobs[job_id]["batches"][batch_id] = sf_ids
+        self.record("post batch", self.jobs[job_id]["sf_object"], len(rows))
+        return batch_id
+
+    def close_job(self, job_id):
+        self.record("close job", self.jobs[job_id]["sf_object"])
+
+    def job_status(self, job_id):
+        batches = len(self.jobs[job_id]["batches"])
+        return {"numberBatchesCompleted": batches, "numberBatchesTotal": batches}
+
+    def headers(self):
+        return {}
+
+    def batch_list(self, job_id):
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<batchInfoList xmlns="{}">{}</batchInfoList>'.format(
+                JOB_NS,
+                "".join(
+                    "<batchInfo><id>{}</id><state>Completed</state></batchInfo>".format(
+                        batch_id
+                    )
+                    for batch_id in self.jobs[job_id]["batches"]
+                ),
+            )
+        )
+
+    def batch_result(self, job_id, batch_id):
+        return '"Id","Success","Created","Error"\n' + "".join(
+            '"{}","true","true",""\n'.format(sf_id)
+            for sf_id in self.jobs[job_id]["batches"][batch_id]
+        )
+
+    def handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parts = self.path.strip("/").split("/")
+                if len(parts) == 3:
+                    body, content_type = api.batch_list(parts[1]), "application/xml"
+                else:
+                    body, content_type = (
+                        api.batch_result(parts[1], parts[3]),
+                        "text/csv",
+                    )
+                    api.record("download results", api.jobs[parts[1]]["sf_object"])
+                body = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class MockSalesforce:
+    """Answers LoadData's record type queries"""
+
+    def query(self, soql):
+        return {"records": [{"Id": "012000000000000AAA"}]}
+
+
+def mock_org_config():
+    return OrgConfig(
+        {"instance_url": "https://example.my.salesforce.com", "access_token": "TOKEN"},
+        "test",
+    )
@@ -0,0 +1,63 @@
+import os
+import sqlite3
+import unittest
+
+from cumulusci.core.config import TaskConfig
+from cumulusci.tests.util import create_project_config
+from cumulusci.utils import temporary_dir
+
+from tasks.clone_dataset import CloneDataset
+
+SEED = os.path.abspath(os.path.join("datasets", "dev_org", "test_data.db"))
+MAPPING = os.path.abspath(os.path.join("datasets", "mapping.yml"))
+
+
+def query(path, sql):
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute(sql).fetchone()
+    finally:
+        connection.close()
+
+
+class TestCloneDataset(unittest.TestCase):
+    def test_copies_keep_their_lookups(self):
+        with temporary_dir() as tempdir:
+            path = os.path.join(tempdir, "cloned.db")
+            task = CloneDataset(
+                create_project_config(),
+                TaskConfig(
+                    {
+                        "options": {
+                            "seed_db": SEED,
+                            "mapping": MAPPING,
+                            "database": path,
+                            "copies": 3,
+                        }
+                    }
+                ),
+            )
+            task()
+            for table in ("households", "contacts", "opportunities"):
+                (seed_rows,) = query(SEED, 'SELECT COUNT(*) FROM "{}"'.format(table))
+                (rows,) = query(path, 'SELECT COUNT(*) FROM "{}"'.format(table))
+                self.assertEqual(seed_rows * 3, rows, table)
+            (households,) = query(
+                SEED, "SELECT COUNT(DISTINCT household_id) FROM contacts"
+            )
+            # Each copy's contacts look up that copy's households
+            self.assertEqual(
+                (households * 3, 0),
+                query(
+                    path,
+                    "SELECT COUNT(DISTINCT c.household_id), "
+                    "SUM(c.household_id IS NOT NULL AND h.household_id IS NULL) "
+                    "FROM contacts AS c LEFT JOIN households AS h "
+                    "ON h.household_id = c.household_id",
+                ),
+            )
+            (names,) = query(path, "SELECT COUNT(DISTINCT last_name) FROM contacts")
+            (seed_names,) = query(
+                SEED, "SELECT COUNT(DISTINCT last_name) FROM contacts"
+            )
+            self.assertEqual(seed_names * 3, names)
@@ -0,0 +1,59 @@
+import csv
+import gzip
+import hashlib
+import json
+import os
+import unittest
+
+from cumulusci.core.config import TaskConfig
+from cumulusci.tests.util import create_project_config
+from cumulusci.utils import temporary_dir
+
+from tasks.export_csv_batches import ExportCSVBatches
+
+DATABASE = os.path.abspath(os.path.join("datasets", "dev_org", "test_data.db"))
+MAPPING = os.path.abspath(os.path.join("datasets", "mapping.yml"))
+
+
+def sha256(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class TestExportCSVBatches(unittest.TestCase):
+    def export(self, csv_dir):
+        task = ExportCSVBatches(
+            create_project_config(),
+            TaskConfig(
+                {
+                    "options": {
+                        "database": DATABASE,
+                        "mapping": MAPPING,
+                        "csv_dir": csv_dir,
+                        "batch_size": 50,
+                        "workers": 2,
+                    }
+                }
+            ),
+        )
+        task()
+        with open(os.path.join(csv_dir, "manifest.json"), "r") as f:
+            return json.load(f)
+
+    def test_manifest_describes_batches(self):
+        with temporary_dir() as tempdir:
+            manifest = self.export(tempdir)
+            self.assertEqual(sha256(DATABASE), manifest["database_sha256"])
+            self.assertEqual(sha256(MAPPING), manifest["mapping_sha256"])
+            self.assertTrue(any(step["rows"] for step in manifest["steps"]))
+            for step in manifest["steps"]:
+                for batch in step["batches"]:
+                    path = os.path.join(tempdir, step["directory"], batch["file"])
+                    self.assertEqual(sha256(path), batch["sha256"])
+                    with gzip.open(path, "rt", newline="", encoding="utf-8") as f:
+                        self.assertEqual(batch["rows"] + 1, len(list(csv.reader(f))))
+                self.assertEqual(
+                    step["rows"], sum(batch["rows"] for batch in step["batches"])
+                )
+            # The batches are byte for byte the same when exported again
+            self.assertEqual(manifest, self.export(tempdir))
@@ -0,0 +1,469 @@
+import csv
+import json
+import os
+import sqlite3
+import time
+import unittest
+from unittest import mock
+
+from cumulusci.core.config import TaskConfig
+from cumulusci.core.exceptions import TaskOptionsError
+from cumulusci.tasks.salesforce import BaseSalesforceTask
+from cumulusci.tests.util import create_project_config
+from cumulusci.utils import temporary_dir
+
+from tasks.generate_bdi_data import BulkInserter
+from tasks.generate_bdi_data import CSVStepWriter
+from tasks.generate_bdi_data import DatabaseCache
+from tasks.generate_bdi_data import GenerateBDIData
+from tasks.generate_bdi_data import GenerateData
+from tasks.generate_bdi_data import PipelinedLoadData
+from tasks.generate_bdi_data import Template
+from tasks.generate_bdi_data import Timings
+from tasks.generate_bdi_data import read_generation_state
+from tasks.tests.bulk_api import MockBulkAPI
+from tasks.tests.bulk_api import MockSalesforce
+from tasks.tests.bulk_api import mock_org_config
+
+MAPPING = os.path.join(
+    os.path.dirname(__file__), "..", "..", "datasets", "bdi_benchmark", "mapping.yml"
+)
+FULL_MAPPING = os.path.join(
+    os.path.dirname(__file__), "..", "..", "datasets", "mapping.yml"
+)
+TABLES = ("accounts", "contacts", "opportunities", "payments", "npsp__DataImport__c")
+SF_OBJECTS = (
+    "Account",
+    "Contact",
+    "Opportunity",
+    "npe01__OppPayment__c",
+    "npsp__DataImport__c",
+)
+
+
+class TaskTestCase(unittest.TestCase):
+    task_class = GenerateBDIData
+
+    def run_task(self, api, path, **options):
+        options = dict(
+            {"mapping_yaml": MAPPING, "num_records": 2000, "debug_db_path": path},
+            **options
+        )
+        task = self.task_class(
+            create_project_config(), TaskConfig({"options": options}), mock_org_config()
+        )
+        generated = []
+        table_generated = task.table_generated
+
+        def record_table(table, rows):
+            table_generated(table, rows)
+            generated.append((time.time() - api.start_time, table))
+
+        task.table_generated = record_table
+        with mock.patch.object(
+            BaseSalesforceTask, "_update_credentials"
+        ), mock.patch.object(
+            PipelinedLoadData, "_init_bulk", return_value=api
+        ), mock.patch.object(
+            PipelinedLoadData, "_init_api", return_value=MockSalesforce()
+        ):
+            task()
+        return generated
+
+    def assert_loaded(self, path):
+        connection = sqlite3.connect(path)
+        try:
+            for table in TABLES:
+                rows, sf_ids = connection.execute(
+                    'SELECT (SELECT COUNT(*) FROM "{0}"), '
+                    '(SELECT COUNT(*) FROM "{0}_sf_ids")'.format(table)
+                ).fetchone()
+                self.assertTrue(rows)
+                self.assertEqual(rows, sf_ids, table)
+            unresolved = connection.execute(
+                "SELECT COUNT(*) FROM payments LEFT JOIN opportunities_sf_ids "
+                "ON opportunities_sf_ids.id = payments.npe01__opportunity__c "
+                "WHERE opportunities_sf_ids.sf_id IS NULL"
+            ).fetchone()[0]
+            self.assertEqual(0, unresolved)
+        finally:
+            connection.close()
+
+
+class TestPipeline(TaskTestCase):
+    def test_pipeline_loads_in_mapping_order(self):
+        with temporary_dir() as tempdir, MockBulkAPI() as api:
+            path = os.path.join(tempdir, "pipelined.db")
+            generated = self.run_task(api, path, pipeline=True, insert_mode="bulk")
+            self.assert_loaded(path)
+        jobs = [event for event in api.events if event[1] == "create job"]
+        self.assertEqual(SF_OBJECTS, tuple(event[3] for event in jobs))
+        # Every step starts once its table and the tables it looks up are
+        # generated, and the first starts before generation has finished
+        generated_at = {table: at for at, table in generated}
+        for (at, _, _, sf_object), table in zip(jobs, TABLES):
+            self.assertGreaterEqual(at, generated_at[table])
+        self.assertLess(jobs[0][0], generated_at[TABLES[-1]])
+
+    def test_pipeline_matches_sequential_load(self):
+        with temporary_dir() as tempdir, MockBulkAPI() as api:
+            sequential = os.path.join(tempdir, "sequential.db")
+            pipelined = os.path.join(tempdir, "pipelined.db")
+            self.run_task(api, sequential, insert_mode="bulk")
+            self.run_task(api, pipelined, insert_mode="bulk", pipeline=True)
+            self.assert_loaded(sequential)
+            self.assert_loaded(pipelined)
+            for table in TABLES:
+                query = 'SELECT * FROM "{}" ORDER BY id'.format(table)
+                self.assertEqual(
+                    sqlite3.connect(sequential).execute(query).fetchall(),
+                    sqlite3.connect(pipelined).execute(query).fetchall(),
+                )
+
+    def test_pipeline_waits_for_generator_to_commit(self):
+        # Hold each table's transaction open long after LoadData is ready to
+        # write the previous table's id table, with a busy timeout that
+        # would fail it if the two wrote at once
+        flush_buffer = BulkInserter.flush_buffer
+
+        def slow_flush_buffer(inserter, key):
+            flush_buffer(inserter, key)
+            time.sleep(0.5)
+
+        with temporary_dir() as tempdir, MockBulkAPI() as api, mock.patch.object(
+            BulkInserter, "flush_buffer", slow_flush_buffer
+        ), mock.patch("tasks.generate_bdi_data.PIPELINE_BUSY_TIMEOUT", 100):
+            path = os.path.join(tempdir, "pipelined.db")
+            generated = self.run_task(api, path, pipeline=True, insert_mode="bulk")
+            self.assert_loaded(path)
+        downloads = [event[0] for event in api.events if event[1] == "download results"]
+        self.assertLess(downloads[0], generated[-1][0])
+
+
+class TestGrow(TaskTestCase):
+    def test_grow_twice_with_index_lookups(self):
+        with temporary_dir() as tempdir, MockBulkAPI() as api:
+            path = os.path.join(tempdir, "grown.db")
+            for num_records in (500, 1000, 2000):
+                self.run_task(
+                    api, path, num_records=num_records, grow=True, index_lookups=True
+                )
+            self.assert_loaded(path)
+            self.assertEqual("2000", read_generation_state(path)["num_records"])
+            connection = sqlite3.connect(path)
+            indexes = connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' "
+                "AND name = 'opportunities_account_id'"
+            ).fetchall()
+            rows = connection.execute("SELECT COUNT(*) FROM opportunities").fetchone()
+            connection.close()
+        self.assertEqual([("opportunities_account_id",)], indexes)
+        self.assertEqual((2000,), rows)
+
+
+class TestGenerateData(TaskTestCase):
+    task_class = GenerateData
+
+    def assert_indexed(self, path):
+        connection = sqlite3.connect(path)
+        indexes = connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' "
+            "AND name = 'payments_opportunity_id'"
+        ).fetchall()
+        connection.close()
+        self.assertEqual([("payments_opportunity_id",)], indexes)
+
+    def test_index_lookups(self):
+        with temporary_dir() as tempdir, MockBulkAPI() as api:
+            path = os.path.join(tempdir, "generated.db")
+            self.run_task(
+                api, path, mapping_yaml=FULL_MAPPING, num_records=20, index_lookups=True
+            )
+            self.assert_indexed(path)
+
+    def test_index_lookups_in_pipeline(self):
+        with temporary_dir() as tempdir, MockBulkAPI() as api:
+            path = os.path.join(tempdir, "generated.db")
+            self.run_task(
+                api,
+                path,
+                mapping_yaml=FULL_MAPPING,
+                num_records=20,
+                index_lookups=True,
+                pipeline=True,
+            )
+            self.assert_indexed(path)
+
+    def test_contention_report(self):
+        with temporary_dir() as tempdir, MockBulkAPI() as api:
+            path = os.path.join(tempdir, "generated.db")
+            self.run_task(
+                api,
+                path,
+                mapping_yaml=FULL_MAPPING,
+                num_records=20,
+                contention_report=True,
+            )
+            with open(os.path.join(tempdir, "generated.contention.json")) as f:
+                report = json.load(f)
+        self.assertIn(
+            ("Insert Payments", "npe01__Opportunity__c"),
+            [(lookup["step"], lookup["lookup"]) for lookup in report],
+        )
+
+    def test_order_by_parent_warns_for_mapped_ids(self):
+        with temporary_dir() as tempdir, MockBulkAPI() as api, self.assertLogs(
+            level="WARNING"
+        ) as logs:
+            path = os.path.join(tempdir, "generated.db")
+            self.run_task(
+                api,
+                path,
+                mapping_yaml=FULL_MAPPING,
+                num_records=20,
+                order_by_parent=True,
+            )
+        self.assertIn(
+            "Not ordering payments by parent: its primary key is the mapped Id "
+            "column sf_id",
+            [record.getMessage() for record in logs.records],
+        )
+
+
+class TestGenerationModes(unittest.TestCase):
+    def generate(self, path, **options):
+        options = dict({"mapping_yaml": MAPPING, "num_records": 300}, **options)
+        task = GenerateBDIData(
+            create_project_config(), TaskConfig({"options": options}), mock_org_config()
+        )
+        task.timings = Timings()
+        task._generate_data("sqlite:///" + path, os.path.abspath(MAPPING))
+        return task
+
+    def table_contents(self, path):
+        connection = sqlite3.connect(path)
+        try:
+            tables = [
+                name
+                for (name,) in connection.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name"
+                )
+            ]
+            return {
+                table: connection.execute(
+                    'SELECT * FROM "{}" ORDER BY rowid'.format(table)
+                ).fetchall()
+                for table in tables
+            }
+        finally:
+            connection.close()
+
+    def test_modes_match_orm(self):
+        modes = {
+            "bulk": {"insert_mode": "bulk"},
+            "sql": {"insert_mode": "sql"},
+            "chunked": {"insert_mode": "bulk", "chunk_size": 70},
+            "workers": {"insert_mode": "bulk", "workers": 2},
+            "sql workers": {"insert_mode": "sql", "workers": 2},
+            "memory": {"insert_mode": "bulk", "storage_mode": "memory"},
+            "unsafe": {"insert_mode": "sql", "storage_mode": "unsafe"},
+        }
+        with temporary_dir() as tempdir:
+            path = os.path.join(tempdir, "orm.db")
+            self.generate(path, insert_mode="orm")
+            expected = self.table_contents(path)
+            self.assertIn("payments", expected)
+            for name, options in modes.items():
+                path = os.path.join(tempdir, "{}.db".format(name.replace(" ", "_")))
+                self.generate(path, **options)
+                self.assertEqual(expected, self.table_contents(path), name)
+
+    def test_generated_rows_are_counted(self):
+        cases = [
+            {"insert_mode": "sql", "grow": True},
+            {"insert_mode": "bulk", "grow": True},
+            {"insert_mode": "bulk", "workers": 2},
+        ]
+        for options in cases:
+            with temporary_dir() as tempdir:
+                path = os.path.join(tempdir, "generated.db")
+                before = {}
+                if options.get("grow"):
+                    self.generate(path, num_records=100)
+                    before = self.table_contents(path)
+                task = self.generate(path, debug_db_path=path, **options)
+                after = self.table_contents(path)
+            added = {
+                table: len(rows) - len(before.get(table, ()))
+                for table, rows in after.items()
+                if table != "generation_state"
+            }
+            phases = {phase["name"]: phase for phase in task.timings.phases}
+            self.assertEqual(sum(added.values()), phases["generation"]["rows"], options)
+            for table in task.timings.tables:
+                self.assertEqual(added[table["name"]], table["rows"], options)
+
+    def test_sql_formats_like_orm(self):
+        with temporary_dir() as tempdir:
+            recipe = os.path.join(tempdir, "recipe.yml")
+            with open(recipe, "w") as f:
+                f.write(
+                    "groups:\n"
+                    "    - proportion: 1\n"
+                    "      segments:\n"
+                    "          - tables:\n"
+                    "                accounts: {name: 'Account %(i)05d'}\n"
+                    "                opportunities:\n"
+                    "                    name: '%(accounts)-6x|%(date)12s|%%'\n"
+                    "                    account_id: '%(accounts)d'\n"
+                )
+            for insert_mode in ("orm", "sql"):
+                self.generate(
+                    os.path.join(tempdir, insert_mode + ".db"),
+                    insert_mode=insert_mode,
+                    recipe=recipe,
+                    num_records=20,
+                )
+            expected = self.table_contents(os.path.join(tempdir, "orm.db"))
+            self.assertEqual("Account 00012", expected["accounts"][11][1])
+            self.assertEqual(
+                expected, self.table_contents(os.path.join(tempdir, "sql.db"))
+            )
+
+    def test_unsupported_format_is_rejected(self):
+        with self.assertRaises(TaskOptionsError):
+            Template("Account %(i)r")
+
+
+class TestTimings(unittest.TestCase):
+    def test_failed_phase_is_timed(self):
+        timings = Timings()
+        with self.assertRaises(ValueError):
+            with timings.phase("generation"):
+                raise ValueError()
+        self.assertEqual(["generation"], [phase["name"] for phase in timings.phases])
+        self.assertIsNotNone(timings.phases[0]["seconds"])
+
+
+class TestCSVOutput(unittest.TestCase):
+    def test_csv_rejects_database_options(self):
+        for name, value in (
+            ("debug_db_path", "/tmp/temp_db.db"),
+            ("cache_dir", "~/.cumulusci/generated_data_cache"),
+        ):
+            options = {
+                "mapping_yaml": MAPPING,
+                "num_records": 10,
+                "output_format": "csv",
+                name: value,
+            }
+            with self.assertRaises(TaskOptionsError) as e:
+                GenerateBDIData(
+                    create_project_config(),
+                    TaskConfig({"options": options}),
+                    mock_org_config(),
+                )
+            self.assertIn(name, str(e.exception))
+
+    def test_step_rows_are_ordered_like_load_data(self):
+        mapping = {
+            "sf_object": "npe01__OppPayment__c",
+            "table": "payments",
+            "fields": {"npe01__Payment_Amount__c": "amount"},
+            "lookups": {"npe01__Opportunity__c": {"table": "opportunities"}},
+        }
+        opportunities = [3, 1, None, 2, 1, 10, None]
+        with temporary_dir() as tempdir:
+            writer = CSVStepWriter(tempdir, mapping, batch_size=4, run_size=2)
+            for id, opportunity in enumerate(opportunities, 1):
+                writer.write(
+                    {"id": id, "amount": 10 * id, "npe01__opportunity__c": opportunity}
+                )
+            writer.close()
+            rows = []
+            for name in sorted(os.listdir(tempdir)):
+                with open(os.path.join(tempdir, name)) as f:
+                    rows.extend(list(csv.reader(f))[1:])
+        # The order of a text lookup column in SQLite, ties in id order
+        connection = sqlite3.connect(":memory:")
+        connection.execute("CREATE TABLE payments (id INTEGER, opportunity TEXT)")
+        connection.executemany(
+            "INSERT INTO payments VALUES (?, ?)", enumerate(opportunities, 1)
+        )
+        expected = connection.execute(
+            "SELECT id FROM payments ORDER BY opportunity, id"
+        ).fetchall()
+        self.assertEqual(["3", "7", "2", "5", "6", "4", "1"], [row[0] for row in rows])
+        self.assertEqual([str(id) for (id,) in expected], [row[0] for row in rows])
+
+
+class TestCacheKey(unittest.TestCase):
+    def cache_key(self, **options):
+        options = dict({"mapping_yaml": MAPPING, "num_records": 10}, **options)
+        task = GenerateBDIData(
+            create_project_config(), TaskConfig({"options": options}), mock_org_config()
+        )
+        return task.cache_key(MAPPING)
+
+    def test_index_lookups_changes_key(self):
+        self.assertNotEqual(self.cache_key(), self.cache_key(index_lookups=True))
+
+    def test_order_by_parent_changes_key(self):
+        self.assertNotEqual(self.cache_key(), self.cache_key(order_by_parent=True))
+
+    def test_unit_table_changes_key(self):
+        def cache_key(**options):
+            options = dict({"mapping_yaml": FULL_MAPPING, "num_records": 10}, **options)
+            task = GenerateData(
+                create_project_config(),
+                TaskConfig({"options": options}),
+                mock_org_config(),
+            )
+            return task.cache_key(FULL_MAPPING)
+
+        self.assertNotEqual(cache_key(), cache_key(unit_table="accounts"))
+
+
+class TestCachedGeneration(TaskTestCase):
+    def test_cache_hit_reports_contention(self):
+        with temporary_dir() as tempdir, MockBulkAPI() as api:
+            cache_dir = os.path.join(tempdir, "cache")
+            self.run_task(api, os.path.join(tempdir, "first.db"), cache_dir=cache_dir)
+            path = os.path.join(tempdir, "second.db")
+            generated = self.run_task(
+                api, path, cache_dir=cache_dir, contention_report=True
+            )
+            self.assertEqual([], generated)
+            self.assert_loaded(path)
+            with open(os.path.join(tempdir, "second.contention.json")) as f:
+                report = json.load(f)
+        self.assertIn("npe01__Opportunity__c", [lookup["lookup"] for lookup in report])
+
+
+class TestDatabaseCache(unittest.TestCase):
+    def test_put_copies_to_its_own_partial_file(self):
+        with temporary_dir() as tempdir:
+            source_path = os.path.join(tempdir, "generated.db")
+            connection = sqlite3.connect(source_path)
+            connection.execute("CREATE TABLE accounts (id INTEGER PRIMARY KEY)")
+            connection.execute("CREATE TABLE accounts_sf_ids (id INTEGER, sf_id TEXT)")
+            connection.commit()
+            connection.close()
+            cache = DatabaseCache(os.path.join(tempdir, "cache"), 1024 * 1024)
+            partial_paths = []
+            copy = cache.copy
+
+            def record_copy(source_path, target_path, exclude_suffix=None):
+                partial_paths.append(target_path)
+                copy(source_path, target_path, exclude_suffix)
+
+            with mock.patch.object(cache, "copy", record_copy):
+                cache.put("key", source_path, exclude_suffix="_sf_ids")
+                cache.put("key", source_path, exclude_suffix="_sf_ids")
+
+            self.assertNotEqual(*partial_paths)
+            self.assertEqual(["key.db"], os.listdir(cache.directory))
+            tables = sqlite3.connect(cache.path("key")).execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"
+            )
+            self.assertEqual([("accounts",)], tables.fetchall())
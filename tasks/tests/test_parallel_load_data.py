@@ -0,0 +1,89 @@
+import os
+import shutil
+import sqlite3
+import time
+import unittest
+from unittest import mock
+
+from cumulusci.core.config import TaskConfig
+from cumulusci.tasks.salesforce import BaseSalesforceTask
+from cumulusci.tests.util import create_project_config
+from cumulusci.utils import temporary_dir
+
+from tasks.generate_bdi_data import PipelinedLoadData
+from tasks.parallel_load_data import ParallelLoadData
+from tasks.parallel_load_data import load_dependencies
+from tasks.tests.bulk_api import MockBulkAPI
+from tasks.tests.bulk_api import MockSalesforce
+from tasks.tests.bulk_api import mock_org_config
+
+DATABASE = os.path.abspath(os.path.join("datasets", "dev_org", "test_data.db"))
+MAPPING = os.path.abspath(os.path.join("datasets", "mapping.yml"))
+
+
+class TimedParallelLoadData(ParallelLoadData):
+    """Notes when each step starts and finishes"""
+
+    def _init_options(self, kwargs):
+        super(TimedParallelLoadData, self)._init_options(kwargs)
+        self.started = {}
+        self.finished = {}
+
+    def _load_step(self, name, mapping):
+        self.started[name] = time.time()
+        result = super(TimedParallelLoadData, self)._load_step(name, mapping)
+        self.finished[name] = time.time()
+        return result
+
+
+class TestParallelLoadData(unittest.TestCase):
+    def load(self, task_class, path, **options):
+        shutil.copy(DATABASE, path)
+        options = dict(
+            {"database_url": "sqlite:///" + path, "mapping": MAPPING}, **options
+        )
+        task = task_class(
+            create_project_config(), TaskConfig({"options": options}), mock_org_config()
+        )
+        with MockBulkAPI() as api, mock.patch.object(
+            BaseSalesforceTask, "_update_credentials"
+        ), mock.patch.object(
+            task_class, "_init_bulk", return_value=api
+        ), mock.patch.object(
+            task_class, "_init_api", return_value=MockSalesforce()
+        ):
+            task()
+        return task
+
+    def id_table_rows(self, path):
+        connection = sqlite3.connect(path)
+        try:
+            return {
+                name: connection.execute(
+                    'SELECT COUNT(*) FROM "{}"'.format(name)
+                ).fetchone()[0]
+                for (name,) in connection.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table' "
+                    "AND name LIKE '%_sf_ids'"
+                )
+            }
+        finally:
+            connection.close()
+
+    def test_parallel_load_matches_sequential_load(self):
+        with temporary_dir() as tempdir:
+            sequential = os.path.join(tempdir, "sequential.db")
+            self.load(PipelinedLoadData, sequential)
+            parallel = os.path.join(tempdir, "parallel.db")
+            task = self.load(TimedParallelLoadData, parallel, workers=4)
+            expected = self.id_table_rows(sequential)
+            self.assertTrue(expected)
+            self.assertEqual(expected, self.id_table_rows(parallel))
+        # Every step starts after the steps it waits for have finished
+        dependencies = load_dependencies(task.mapping)
+        self.assertEqual(set(dependencies), set(task.started))
+        for name, depends in dependencies.items():
+            for dependency in depends:
+                self.assertLessEqual(
+                    task.finished[dependency], task.started[name], (dependency, name)
+                )
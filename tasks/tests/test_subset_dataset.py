@@ -0,0 +1,69 @@
+import os
+import sqlite3
+import unittest
+
+from cumulusci.core.config import TaskConfig
+from cumulusci.core.utils import ordered_yaml_load
+from cumulusci.tests.util import create_project_config
+from cumulusci.utils import temporary_dir
+
+from tasks.generate_bdi_data import get_lookup_key_field
+from tasks.subset_dataset import SubsetDataset
+
+SOURCE = os.path.abspath(os.path.join("datasets", "dev_org", "test_data.db"))
+MAPPING = os.path.abspath(os.path.join("datasets", "mapping.yml"))
+
+
+class TestSubsetDataset(unittest.TestCase):
+    def test_subset_has_no_dangling_lookups(self):
+        with open(MAPPING, "r") as f:
+            mappings = ordered_yaml_load(f)
+        with temporary_dir() as tempdir:
+            path = os.path.join(tempdir, "subset.db")
+            task = SubsetDataset(
+                create_project_config(),
+                TaskConfig(
+                    {
+                        "options": {
+                            "source_db": SOURCE,
+                            "mapping": MAPPING,
+                            "database": path,
+                            "num_roots": 10,
+                        }
+                    }
+                ),
+            )
+            task()
+            connection = sqlite3.connect(path)
+            try:
+                households = connection.execute(
+                    "SELECT COUNT(*) FROM households"
+                ).fetchone()
+                contacts = connection.execute(
+                    "SELECT COUNT(*) FROM contacts"
+                ).fetchone()
+                dangling = {}
+                for mapping in mappings.values():
+                    for sf_field, lookup in mapping.get("lookups", {}).items():
+                        parent = lookup["table"]
+                        key = connection.execute(
+                            'SELECT name FROM pragma_table_info("{}") WHERE pk'.format(
+                                parent
+                            )
+                        ).fetchone()[0]
+                        column = get_lookup_key_field(lookup, sf_field)
+                        dangling[mapping["table"], column] = connection.execute(
+                            'SELECT COUNT(*) FROM "{0}" AS c WHERE c."{1}" IS NOT NULL '
+                            "AND c.\"{1}\" != '' AND NOT EXISTS (SELECT 1 FROM "
+                            '"{2}" AS p WHERE p."{3}" = c."{1}")'.format(
+                                mapping["table"], column, parent, key
+                            )
+                        ).fetchone()[0]
+            finally:
+                connection.close()
+        self.assertGreaterEqual(households[0], 10)
+        self.assertTrue(0 < contacts[0] < 100)
+        self.assertTrue(dangling)
+        self.assertEqual(
+            {}, {lookup: rows for lookup, rows in dangling.items() if rows}
+        )
@@ -0,0 +1,67 @@
+import json
+import os
+import shutil
+import sqlite3
+import unittest
+
+from cumulusci.core.config import TaskConfig
+from cumulusci.core.exceptions import BulkDataException
+from cumulusci.tests.util import create_project_config
+from cumulusci.utils import temporary_dir
+
+from tasks.validate_dataset import ValidateDataset
+
+DATABASE = os.path.abspath(os.path.join("datasets", "dev_org", "test_data.db"))
+MAPPING = os.path.abspath(os.path.join("datasets", "mapping.yml"))
+
+
+class TestValidateDataset(unittest.TestCase):
+    def validate(self, path, report_path):
+        task = ValidateDataset(
+            create_project_config(),
+            TaskConfig(
+                {
+                    "options": {
+                        "database": path,
+                        "mapping": MAPPING,
+                        "report_path": report_path,
+                    }
+                }
+            ),
+        )
+        task()
+
+    def test_dataset_is_valid(self):
+        with temporary_dir() as tempdir:
+            report_path = os.path.join(tempdir, "report.json")
+            self.validate(DATABASE, report_path)
+            with open(report_path, "r") as f:
+                report = json.load(f)
+        self.assertEqual([], report["problems"])
+        self.assertTrue(all(step["rows"] for step in report["steps"]))
+
+    def test_dangling_lookup_is_reported(self):
+        with temporary_dir() as tempdir:
+            path = os.path.join(tempdir, "test_data.db")
+            shutil.copy(DATABASE, path)
+            connection = sqlite3.connect(path)
+            (contact,) = connection.execute(
+                "SELECT MIN(id) FROM contacts WHERE household_id IS NOT NULL"
+            ).fetchone()
+            connection.execute(
+                "UPDATE contacts SET household_id = 999999 WHERE id = ?", (contact,)
+            )
+            connection.commit()
+            connection.close()
+            report_path = os.path.join(tempdir, "report.json")
+            with self.assertRaises(BulkDataException):
+                self.validate(path, report_path)
+            with open(report_path, "r") as f:
+                report = json.load(f)
+        dangling = [
+            (problem["step"], problem["lookup"], problem["rows"], problem["example"])
+            for problem in report["problems"]
+        ]
+        self.assertEqual(
+            [("Insert Household Contacts", "AccountId", 1, contact)], dangling
+        )
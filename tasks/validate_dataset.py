@@ -0,0 +1,336 @@
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from itertools import chain
+from cumulusci.core.tasks import BaseTask
+from cumulusci.core.exceptions import BulkDataException
+from cumulusci.core.exceptions import TaskOptionsError
+from cumulusci.core.utils import ordered_yaml_load
+
+from tasks.generate_bdi_data import LOAD_BATCH_SIZE
+from tasks.generate_bdi_data import column_affinity
+from tasks.generate_bdi_data import fields_for_mapping
+from tasks.generate_bdi_data import get_lookup_key_field
+from tasks.generate_bdi_data import load_filters
+from tasks.generate_bdi_data import update_steps
+
+
+# Records per second the Bulk API loads, for ValidateDataset's estimates
+# when no throughput profile is given.  NPSP's triggers keep this low.
+DEFAULT_THROUGHPUT = {"default": 200}
+# The length of the Unicode columns QueryData creates
+MAX_VALUE_LENGTH = 255
+
+
+class ValidateDataset(BaseTask):
+    task_docs = """
+    Check a dataset database against its mapping file before loading it, so
+    that a load does not fail halfway through.  Every lookup must point at
+    a row that a mapping step loads, and before the step that needs it
+    unless the lookup has an `after:`.  Every mapped column must exist and
+    hold values that fit the 255 character columns QueryData creates.
+
+    Also counts the rows of each step, including the updates LoadData runs
+    for `after:` lookups, and estimates the Bulk API batches and load time.
+    The throughput profile is a YAML file of records per second for each
+    sObject, with a `default` for the others.  Problems are logged together
+    and then fail the task.
+    """
+
+    task_options = {
+        "database": {
+            "description": "The SQLite dataset database to check",
+            "required": True,
+        },
+        "mapping": {
+            "description": "The mapping file the database is loaded with",
+            "required": True,
+        },
+        "batch_size": {
+            "description": "The number of records in each Bulk API batch. Defaults to 10000.",
+            "required": False,
+        },
+        "throughput": {
+            "description": "A YAML file of the records per second to estimate each sObject's "
+            "load time with. Defaults to 200 for every sObject.",
+            "required": False,
+        },
+        "report_path": {
+            "description": "A path to write the checks and estimates to as JSON",
+            "required": False,
+        },
+    }
+
+    def _init_options(self, kwargs):
+        super(ValidateDataset, self)._init_options(kwargs)
+        self.options["batch_size"] = int(
+            self.options.get("batch_size") or LOAD_BATCH_SIZE
+        )
+        if not os.path.isfile(self.options["database"]):
+            raise TaskOptionsError("No database at {}".format(self.options["database"]))
+
+    def _run_task(self):
+        with open(self.options["mapping"], "r") as f:
+            mappings = ordered_yaml_load(f)
+        throughput = read_throughput(self.options.get("throughput"))
+        start = time.perf_counter()
+        connection = sqlite3.connect(self.options["database"])
+        try:
+            problems = validate_dataset(connection, mappings)
+            steps = list(
+                load_estimates(
+                    connection, mappings, throughput, self.options["batch_size"]
+                )
+            )
+        finally:
+            connection.close()
+        for problem in problems:
+            self.logger.error(problem["message"])
+        for step in steps:
+            self.logger.info(
+                "{name}: {rows} rows in {batches} batches, about {seconds:.0f}s".format(
+                    **step
+                )
+            )
+        self.logger.info(
+            "{} rows in {} batches; estimated load time {:.1f} minutes".format(
+                sum(step["rows"] for step in steps),
+                sum(step["batches"] for step in steps),
+                sum(step["seconds"] for step in steps) / 60,
+            )
+        )
+        self.logger.info(
+            "Checked {} in {:.2f}s".format(
+                self.options["database"], time.perf_counter() - start
+            )
+        )
+        if self.options.get("report_path"):
+            with open(self.options["report_path"], "w") as f:
+                json.dump({"problems": problems, "steps": steps}, f, indent=4)
+            self.logger.info("Wrote report to {}".format(self.options["report_path"]))
+        if problems:
+            raise BulkDataException(
+                "{} has {} problems; see the log above".format(
+                    self.options["database"], len(problems)
+                )
+            )
+
+
+def read_throughput(path=None):
+    """Read a throughput profile of records per second for each sObject,
+       with a default for the rest"""
+    if not path:
+        return DEFAULT_THROUGHPUT
+    with open(path, "r") as f:
+        return dict(DEFAULT_THROUGHPUT, **ordered_yaml_load(f))
+
+
+def validate_dataset(connection, mappings):
+    """Check a dataset database against its mapping and describe each
+       problem found as a dict with a message.  The rows are only checked
+       once the tables, columns and step order are right."""
+    problems = []
+    columns = {}
+    for mapping in mappings.values():
+        if mapping["table"] not in columns:
+            columns[mapping["table"]] = OrderedDict(
+                (row[1], row)
+                for row in connection.execute(
+                    'PRAGMA table_info("{}")'.format(mapping["table"])
+                )
+            )
+    loaded = set()
+    for name, mapping in mappings.items():
+        table = mapping["table"]
+        if not any(row[5] for row in columns[table].values()):
+            problems.append(
+                {
+                    "step": name,
+                    "message": "{}: there is no {} table with a primary key".format(
+                        name, table
+                    ),
+                }
+            )
+            continue
+        for field in fields_for_mapping(mapping):
+            # LoadData sends the primary key in place of a mapped Id
+            if field["sf"] != "Id" and field["db"] not in columns[table]:
+                problems.append(
+                    {
+                        "step": name,
+                        "column": field["db"],
+                        "message": "{}: {} has no {} column".format(
+                            name, table, field["db"]
+                        ),
+                    }
+                )
+        for sf_field, lookup in mapping.get("lookups", {}).items():
+            if "after" in lookup:
+                if lookup["after"] not in mappings:
+                    problems.append(
+                        {
+                            "step": name,
+                            "lookup": sf_field,
+                            "message": "{}: {} is loaded after {}, "
+                            "which is not a step".format(name, sf_field, lookup["after"]),
+                        }
+                    )
+            elif lookup["table"] not in loaded:
+                problems.append(
+                    {
+                        "step": name,
+                        "lookup": sf_field,
+                        "message": "{}: {} looks up {} before any step loads it; "
+                        "give it an after: step".format(
+                            name, sf_field, lookup["table"]
+                        ),
+                    }
+                )
+        loaded.add(table)
+    if problems:
+        return problems
+    for name, mapping in mappings.items():
+        problems.extend(dangling_lookups(connection, name, mapping, mappings, columns))
+    checked = set()
+    for mapping in mappings.values():
+        table = mapping["table"]
+        if table not in checked:
+            checked.add(table)
+            problems.extend(long_values(connection, table, mappings, columns[table]))
+    return problems
+
+
+def dangling_lookups(connection, name, mapping, mappings, columns):
+    """Describe the lookups of a mapping step that point at rows no mapping
+       step loads.  Each lookup is an anti-join on the parent table's
+       primary key, so it reads the step's rows once."""
+    table = mapping["table"]
+    key = next(column for column, row in columns[table].items() if row[5])
+    filters = load_filters(mapping, columns[table])
+    for sf_field, lookup in mapping.get("lookups", {}).items():
+        column = get_lookup_key_field(lookup, sf_field)
+        parent = lookup["table"]
+        parent_key = next(column for column, row in columns[parent].items() if row[5])
+        value = 'c."{}"'.format(column)
+        # Compare as text when the parent's key is text so that the
+        # comparison can use its index
+        parent_affinity = column_affinity(columns[parent][parent_key][2])
+        if parent_affinity == "TEXT" != column_affinity(columns[table][column][2]):
+            value = "CAST({} AS TEXT)".format(value)
+        # A parent row is loaded if any step for its table selects it
+        parent_filters = [
+            " AND ".join("({})".format(f) for f in load_filters(step, columns[parent]))
+            or "1"
+            for step in mappings.values()
+            if step["table"] == parent
+        ]
+        count, example = connection.execute(
+            'SELECT COUNT(*), MIN(c."{key}") FROM "{table}" AS c WHERE {filters}'
+            "{value} IS NOT NULL AND {value} != '' AND NOT EXISTS ("
+            'SELECT 1 FROM "{parent}" AS p WHERE p."{parent_key}" = {value} '
+            "AND ({parent_filters}))".format(
+                key=key,
+                table=table,
+                filters="".join("({}) AND ".format(f) for f in filters),
+                value=value,
+                parent=parent,
+                parent_key=parent_key,
+                parent_filters=" OR ".join(parent_filters),
+            )
+        ).fetchone()
+        if count:
+            yield {
+                "step": name,
+                "lookup": sf_field,
+                "rows": count,
+                "example": example,
+                "message": "{}: {} {} rows look up {} rows that are not loaded, "
+                "such as row {}".format(name, count, table, parent, example),
+            }
+
+
+def long_values(connection, table, mappings, columns, max_length=MAX_VALUE_LENGTH):
+    """Describe the mapped columns of a table with values longer than
+       max_length, reading the table once"""
+    key = next(column for column, row in columns.items() if row[5])
+    mapped = OrderedDict()
+    for mapping in mappings.values():
+        if mapping["table"] == table:
+            for field in fields_for_mapping(mapping):
+                if field["sf"] != "Id" and field["db"] != key:
+                    mapped[field["db"]] = None
+            if "record_type" in mapping and "record_type" in columns:
+                mapped["record_type"] = None
+    if not mapped:
+        return
+    terms = []
+    for column in mapped:
+        terms.append('SUM(length("{}") > {})'.format(column, int(max_length)))
+        terms.append(
+            'MIN(CASE WHEN length("{}") > {} THEN "{}" END)'.format(
+                column, int(max_length), key
+            )
+        )
+    row = connection.execute(
+        'SELECT {} FROM "{}"'.format(", ".join(terms), table)
+    ).fetchone()
+    for column, count, example in zip(mapped, row[::2], row[1::2]):
+        if count:
+            yield {
+                "table": table,
+                "column": column,
+                "rows": count,
+                "example": example,
+                "message": "{}.{}: {} values are longer than {} characters, "
+                "such as row {}".format(table, column, count, max_length, example),
+            }
+
+
+def load_estimates(connection, mappings, throughput, batch_size=LOAD_BATCH_SIZE):
+    """Count the rows LoadData sends for each mapping step, and for the
+       update steps it adds for `after:` lookups, and estimate each step's
+       batches and seconds"""
+    columns = {}
+    updates = update_steps(mappings)
+    for name, mapping in mappings.items():
+        for step_name, step in chain(
+            [(name, mapping)],
+            ((update, mappings[step]) for update, step in updates[name].items()),
+        ):
+            table = step["table"]
+            if table not in columns:
+                columns[table] = [
+                    row[1]
+                    for row in connection.execute(
+                        'PRAGMA table_info("{}")'.format(table)
+                    )
+                ]
+            if step_name == name:
+                filters = load_filters(step, columns[table])
+            else:
+                # LoadData skips the rows of an update with no lookups to set
+                filters = [
+                    " OR ".join(
+                        "(\"{0}\" IS NOT NULL AND \"{0}\" != '')".format(
+                            get_lookup_key_field(lookup, sf_field)
+                        )
+                        for sf_field, lookup in step["lookups"].items()
+                        if lookup.get("after") == name
+                    )
+                ]
+            query = 'SELECT COUNT(*) FROM "{}"'.format(table)
+            if filters:
+                query += " WHERE " + " AND ".join("({})".format(f) for f in filters)
+            (rows,) = connection.execute(query).fetchone()
+            rate = throughput.get(step["sf_object"], throughput["default"])
+            yield OrderedDict(
+                [
+                    ("name", step_name),
+                    ("sf_object", step["sf_object"]),
+                    ("rows", rows),
+                    ("batches", -(-rows // batch_size)),
+                    ("seconds", rows / rate),
+                ]
+            )